@@ -1,16 +1,33 @@
 import os
+import re
+import sys
+import json
+import time
 import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
 import pandas as pd
 import zipfile
-import geopandas as gpd
-import rasterio
-import fortranformat as ff
-from osgeo import gdal  # include imports with the function definition (not where you call it)
-from osgeo import osr
-from osgeo import ogr
+# geopandas, rasterio, pyproj, fortranformat and GDAL are imported by the functions using them, so scripts that
+# only download, copy or concatenate files do not pay for loading them
 
 
-def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█'):
+# Minimum seconds between two refreshes of print_progress_bar; the first and last iterations are always printed
+PROGRESS_INTERVAL = 0.5
+progress_state = {'time': 0.0}
+
+# Seconds, calls, bytes and files per processing stage of the current run, see timed_stage and report_metrics
+run_metrics = {}
+metrics_lock = threading.Lock()
+
+
+def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', interval=None):
     """
         Call in a loop to create terminal progress bar
         @params:
@@ -21,9 +38,14 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
             decimals    - Optional  : positive number of decimals in percent complete (Int)
             length      - Optional  : character length of bar (Int)
             fill        - Optional  : bar fill character (Str)
+            interval    - Optional  : minimum seconds between two refreshes, PROGRESS_INTERVAL by default (Float)
             ref: https://gist.github.com/snakers4/91fa21b9dda9d055a02ecd23f24fbc3d
 	"""
-
+    # updates in between refreshes are dropped, so calling this on every iteration costs no terminal write
+    now = time.monotonic()
+    if 0 < iteration < total and now - progress_state['time'] < (PROGRESS_INTERVAL if interval is None else interval):
+        return
+    progress_state['time'] = now
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filled_length = int(length * iteration // total)
     bar = fill * filled_length + '-' * (length - filled_length)
@@ -33,6 +55,101 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
+def add_metrics(stage, seconds=0.0, n_bytes=0, n_files=0, calls=1, metrics=None):
+    """
+    Accumulates the cost of a processing stage, e.g., download, unzip, open, read, sample, assemble or write.
+    Thread safe, so the download threads share the run metrics
+    :param metrics: Dictionary accumulated into, run_metrics of the process by default
+    """
+    metrics = run_metrics if metrics is None else metrics
+    with metrics_lock:
+        entry = metrics.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'bytes': 0, 'files': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += calls
+        entry['bytes'] += int(n_bytes)
+        entry['files'] += int(n_files)
+
+
+@contextmanager
+def timed_stage(stage, n_bytes=0, n_files=0, metrics=None):
+    """
+    Times the enclosed block as one call of stage. Bytes and files known only inside the block are set on the
+    yielded dictionary, e.g., with timed_stage('read', n_files=1) as counts: counts['bytes'] = band.nbytes
+    """
+    counts = {'bytes': n_bytes, 'files': n_files}
+    t0 = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        add_metrics(stage, time.perf_counter() - t0, counts['bytes'], counts['files'], metrics=metrics)
+
+
+def merge_metrics(metrics, into=None):
+    """
+    Adds metrics collected in a worker process, e.g., returned with its results, to the run metrics
+    """
+    for stage, entry in metrics.items():
+        add_metrics(stage, entry['seconds'], entry['bytes'], entry['files'], calls=entry['calls'], metrics=into)
+
+
+def pop_metrics():
+    """
+    Returns the run metrics collected so far and starts over, so a worker process can return the metrics of each
+    task with its results. In the parent process, merging them back leaves the run metrics unchanged
+    """
+    with metrics_lock:
+        metrics = dict(run_metrics)
+        run_metrics.clear()
+    return metrics
+
+
+def get_peak_memory():
+    """
+    Peak resident memory in MB of the process or of its largest finished worker, None where the resource module is
+    not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def report_metrics(t0, metrics_file=None, metrics=None, **run_info):
+    """
+    Prints the time spent per stage and optionally saves the run summary as JSON, so runs can be compared.
+    Stage seconds are summed over download threads and worker processes and can exceed the wall time
+    :param t0: datetime the run started
+    :param metrics_file: Optional. Path of the JSON summary
+    :param metrics: Metrics to report, run_metrics by default
+    :param run_info: Saved as is, e.g., script and arguments of the run
+    :return: Summary
+    """
+    metrics = run_metrics if metrics is None else metrics
+    wall_seconds = (datetime.now() - t0).total_seconds()
+    stages = {}
+    for stage, entry in metrics.items():
+        seconds = entry['seconds']
+        stages[stage] = {'seconds': round(seconds, 6), 'calls': entry['calls'], 'bytes': entry['bytes'],
+                         'files': entry['files'],
+                         'mb_per_second': round(entry['bytes'] / 1e6 / seconds, 3) if seconds > 0 else None,
+                         'files_per_second': round(entry['files'] / seconds, 3) if seconds > 0 else None}
+    summary = {**run_info, 'started': t0.isoformat(timespec='seconds'), 'wall_seconds': round(wall_seconds, 3),
+               'peak_memory_mb': get_peak_memory(), 'stages': stages}
+    print(f'Completed in {round(wall_seconds, 3)} seconds, peak memory {summary["peak_memory_mb"]} MB')
+    for stage, entry in stages.items():
+        print(f'  {stage:<10}{entry["seconds"]:>12.3f} seconds {entry["calls"]:>9} calls {entry["files"]:>9} files '
+              f'{entry["bytes"] / 1e6:>12.1f} MB')
+    if metrics_file is not None:
+        with open(metrics_file, 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
+        print(f'Metrics are saved in {metrics_file}')
+    return summary
+
+
 def create_save_folder(root_dir, sub_dir):
     out_dir = os.path.join(root_dir, sub_dir)
     if not os.path.isdir(out_dir):
@@ -41,8 +158,9 @@ def create_save_folder(root_dir, sub_dir):
 
 
 def do_zip(file_path, destination):
-    with zipfile.ZipFile(file_path) as zf:
-        zf.extractall(destination)
+    with timed_stage('unzip', n_bytes=os.path.getsize(file_path), n_files=1):
+        with zipfile.ZipFile(file_path) as zf:
+            zf.extractall(destination)
     output_file = file_path.split('/')[-1]
     # print(f'{output_file} is unzipped under {destination}')
 
@@ -71,6 +189,9 @@ def raster_info(raster):
         GEOGCS gives you the geographic coordinate system (horizontal/angular: latitude and longitude in degrees).
         VERT_CS gives you the vertical coordinate system (vertical/linear: elevation or depth in linear units like meters or feet).
     """
+    import rasterio
+    from osgeo import gdal
+    from osgeo import osr
     # Check the type of raster input
     if isinstance(raster, rasterio.io.DatasetReader):  # you can directly access the crs attribute of the raster dataset
         raster_detail = raster.crs.wkt
@@ -132,15 +253,186 @@ def get_station_list(main_path, station_file, var_name, year='1981', ymd='198101
     except:
         df_stations = pd.read_csv(csv_file_path, index_col=0, skiprows=1)
     df_stations.columns = ['Name', 'Longitude', 'Latitude', 'Elevation(m)', 'Network', 'stnid']
+    # Stations are keyed by their id downstream; names are not unique
+    if not df_stations.index.is_unique:
+        duplicated = df_stations.index[df_stations.index.duplicated()].unique()
+        raise ValueError(f'Station ids of {csv_file_path} are not unique, e.g., {list(duplicated[:5])}')
     return csv_file_path, df_stations
 
 
-def read_bil_file(main_path, var_name, year, ymd, scale):
+def get_polygon_list(main_path, polygon_file, id_field):
+    """
+    Reads polygons (e.g., subbasins or counties) to be sampled like stations with area weights
+    :param polygon_file: Shapefile or any file read by geopandas, relative to main_path unless absolute
+    :param id_field: Attribute holding the unique id of each polygon
+    :return: Path of the file and a GeoDataFrame indexed by id with the columns of a station list, where Longitude
+             and Latitude locate a point inside each polygon
+    """
+    import geopandas as gpd
+    polygon_file_path = os.path.join(main_path, polygon_file)
+    gdf = gpd.read_file(polygon_file_path)
+    points = gdf.geometry.representative_point().to_crs('EPSG:4326')
+    gdf_polygons = gpd.GeoDataFrame({'Name': gdf[id_field].astype(str).values, 'Longitude': points.x.values,
+                                     'Latitude': points.y.values, 'Elevation(m)': np.nan, 'Network': None,
+                                     'stnid': gdf[id_field].values},
+                                    geometry=gdf.geometry.values, crs=gdf.crs,
+                                    index=pd.Index(gdf[id_field].values, name='Station'))
+    return polygon_file_path, gdf_polygons
+
+
+# Archives of each Zip_Folder/<scale>/<var_name> by the dates in their names, with the directory mtime they were
+# listed at, so a directory is listed again only after downloads changed it
+zip_indexes = {}
+
+
+def get_zip_index(zip_dir):
+    """
+    Groups the archives of zip_dir by each number in their name, e.g., 20200101, and YYYY_all for yearly archives
+    :return: Dictionary of key to the sorted archive names
+    """
+    mtime = os.stat(zip_dir).st_mtime_ns
+    cached = zip_indexes.get(zip_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    zip_index = {}
+    for file in sorted(os.listdir(zip_dir)):
+        if not file.endswith('.zip'):
+            continue
+        tokens = file[:-len('.zip')].split('_')
+        for i, token in enumerate(tokens):
+            if token.isdigit():
+                zip_index.setdefault(token, []).append(file)
+                if tokens[i + 1:i + 2] == ['all']:
+                    zip_index.setdefault(f'{token}_all', []).append(file)
+    zip_indexes[zip_dir] = mtime, zip_index
+    return zip_index
+
+
+def get_zip_files(main_path, var_name, ymd, scale):
+    """
+    Archives downloaded for `ymd` under Zip_Folder, looked up in the cached listing of get_zip_index
+    :return: List of archive paths, empty when none exists
+    """
+    zip_dir = os.path.join(main_path, 'Prism/Zip_Folder', scale, var_name)
+    if not os.path.isdir(zip_dir):
+        return []
+    zip_index = get_zip_index(zip_dir)
+    # monthly grids before 1981 are distributed as one archive per year
+    zip_files = zip_index.get(ymd) or zip_index.get(f'{ymd[:4]}_all', [])
+    return [os.path.join(zip_dir, zip_file) for zip_file in zip_files]
+
+
+def get_zip_member(main_path, var_name, ymd, scale):
+    """
+    Finds the archive downloaded for `ymd` under Zip_Folder and its raster member
+    :return: GDAL /vsizip/ path of the raster inside the archive, or None when no archive exists
+    """
+    for zip_file_path in get_zip_files(main_path, var_name, ymd, scale):
+        with zipfile.ZipFile(zip_file_path) as zf:
+            for member in zf.namelist():
+                if (member.endswith('.bil') or member.endswith('.tif')) and ymd in member:
+                    return f'/vsizip/{zip_file_path}/{member}'
+    return None
+
+
+@lru_cache(maxsize=16)
+def parse_bil_header(header_text):
+    """
+    Parses the text of an ESRI .hdr sidecar once per grid layout
+    :return: Dictionary with the keys of the header in upper case
+    """
+    header = {}
+    for line in header_text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            header[parts[0].upper()] = parts[1]
+    return header
+
+
+@lru_cache(maxsize=16)
+def parse_prj(prj_text):
+    import rasterio
+    return rasterio.crs.CRS.from_wkt(prj_text)
+
+
+class BilRaster:
+    """
+    Read-only memory-mapped view of a band interleaved (.bil) grid and its .hdr/.prj sidecars.
+    Exposes the attributes of rasterio datasets used for extraction so that sampling a few thousand pixels only
+    touches the pages holding them.
+    """
+    pixel_types = {('FLOAT', 32): 'f4', ('FLOAT', 64): 'f8', ('SIGNEDINT', 8): 'i1', ('SIGNEDINT', 16): 'i2',
+                   ('SIGNEDINT', 32): 'i4', ('UNSIGNEDINT', 8): 'u1', ('UNSIGNEDINT', 16): 'u2',
+                   ('UNSIGNEDINT', 32): 'u4'}
+
+    def __init__(self, bil_file_path):
+        import rasterio
+        stem = os.path.splitext(bil_file_path)[0]
+        with open(f'{stem}.hdr') as f:
+            header = parse_bil_header(f.read())
+        with open(f'{stem}.prj') as f:
+            self.crs = parse_prj(f.read().strip())
+        if header.get('LAYOUT', 'BIL').upper() != 'BIL':
+            raise ValueError(f'Layout {header["LAYOUT"]} of {bil_file_path} is not supported')
+        pixel_type = header.get('PIXELTYPE', 'UNSIGNEDINT').upper()
+        n_bits = int(header.get('NBITS', 8))
+        if (pixel_type, n_bits) not in self.pixel_types:
+            raise ValueError(f'Pixel type {pixel_type} {n_bits} of {bil_file_path} is not supported')
+        byte_order = '>' if header.get('BYTEORDER', 'I').upper() in ('M', 'MSBFIRST') else '<'
+        self.name = bil_file_path
+        self.height, self.width = int(header['NROWS']), int(header['NCOLS'])
+        self.count = int(header.get('NBANDS', 1))
+        self.dtypes = (np.dtype(byte_order + self.pixel_types[(pixel_type, n_bits)]).name,) * self.count
+        self.nodata = float(header['NODATA']) if 'NODATA' in header else None
+        x_dim, y_dim = float(header['XDIM']), float(header['YDIM'])
+        # ULXMAP/ULYMAP give the center of the upper left pixel
+        self.transform = rasterio.Affine(x_dim, 0.0, float(header['ULXMAP']) - x_dim / 2,
+                                         0.0, -y_dim, float(header['ULYMAP']) + y_dim / 2)
+        self.data = np.memmap(bil_file_path, dtype=byte_order + self.pixel_types[(pixel_type, n_bits)], mode='r',
+                              shape=(self.height, self.count, self.width))
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def profile(self):
+        return {'driver': 'EHdr', 'dtype': self.dtypes[0], 'nodata': self.nodata, 'width': self.width,
+                'height': self.height, 'count': self.count, 'crs': self.crs, 'transform': self.transform}
+
+    def read(self, indexes=1, window=None):
+        """
+        Returns band `indexes` (1-based) as a memory-mapped array, or the part of it covered by `window`
+        """
+        band = self.data[:, indexes - 1, :]
+        if window is not None:
+            band = np.array(band[window.row_off:window.row_off + window.height,
+                                 window.col_off:window.col_off + window.width])
+        return band
+
+    def close(self):
+        self.data = None
+
+
+def read_bil_file(main_path, var_name, year, ymd, scale, from_zip=None, memmap=True):
+    """
+    Opens the raster of `ymd` either from the extracted folder under Variables or straight from the downloaded zip
+    :param from_zip: True reads the archive, False the extracted folder, None (default) the folder if it exists
+    :param memmap: Extracted .bil grids are memory-mapped with BilRaster; .tif grids and archives use rasterio
+    """
+    import rasterio
     data_dir = os.path.join(main_path, 'Prism/Variables')
     sub_dir = os.path.join(data_dir, scale)
     sub_dir = os.path.join(sub_dir, var_name)
     # sub_dir = os.path.join(sub_dir, year)
     sub_dir = os.path.join(sub_dir, ymd)
+    if from_zip is None:
+        from_zip = not os.path.isdir(sub_dir)
+    if from_zip:
+        bil_file_path = get_zip_member(main_path, var_name, ymd, scale)
+        if bil_file_path is None:
+            raise FileNotFoundError(f'No downloaded archive of {var_name} for {ymd}')
+        return rasterio.open(bil_file_path)
     files = os.listdir(sub_dir)
     bil_file = None
     for file in files:
@@ -149,15 +441,444 @@ def read_bil_file(main_path, var_name, year, ymd, scale):
             bil_file = file
             break
     bil_file_path = os.path.join(sub_dir, bil_file)
+    if memmap and bil_file.endswith('.bil'):
+        try:
+            return BilRaster(bil_file_path)
+        except (OSError, KeyError, ValueError) as e:
+            print(f'Reading {bil_file} with rasterio: {e}')
     raster = rasterio.open(bil_file_path)
     return raster
 
 
+def get_raster_mtime(main_path, var_name, ymd, scale):
+    """
+    Modification time of the raster of `ymd`, either extracted under Variables or kept as an archive
+    :return: Seconds since the epoch, or None when the raster was not downloaded
+    """
+    sub_dir = os.path.join(main_path, 'Prism/Variables', scale, var_name, ymd)
+    if os.path.isdir(sub_dir):
+        for file in os.listdir(sub_dir):
+            if file.endswith('.bil') or file.endswith('.tif'):
+                return os.path.getmtime(os.path.join(sub_dir, file))
+    # the archive is not opened, its mtime is the one of the raster it holds
+    zip_files = get_zip_files(main_path, var_name, ymd, scale)
+    if len(zip_files) == 0:
+        return None
+    return max(os.path.getmtime(zip_file_path) for zip_file_path in zip_files)
+
+
+def get_cube_path(main_path, var_name, year, scale):
+    return os.path.join(main_path, 'Prism/Cube', scale, var_name, f'PRISM_{var_name}_{year}_cube.tif')
+
+
+def read_cube(cube_file):
+    import rasterio
+    return rasterio.open(cube_file)
+
+
+def read_cube_pixels(cube, df_pixels):
+    """
+    Reads every band (day) of a raster cube for a set of pixels with one windowed read per tile holding stations
+    :param cube: Opened cube written by build_cube.py, one band per day
+    :param df_pixels: Station pixels as returned by get_station_pixels or get_station_index
+    :return: Array of shape (stations, days); stations outside the grid get the cube nodata value
+    """
+    import rasterio
+    rows, cols = df_pixels.row.values, df_pixels.col.values
+    nodata = 0 if cube.nodata is None else cube.nodata
+    values = np.full((len(rows), cube.count), nodata, dtype=cube.dtypes[0])
+    is_inside = (rows >= 0) & (rows < cube.height) & (cols >= 0) & (cols < cube.width)
+    inside = np.flatnonzero(is_inside)
+    block_height, block_width = cube.block_shapes[0]
+    block_id = (rows[inside] // block_height) * cube.width + cols[inside] // block_width
+    for block in np.unique(block_id):
+        members = inside[block_id == block]
+        row_off = rows[members[0]] // block_height * block_height
+        col_off = cols[members[0]] // block_width * block_width
+        window = rasterio.windows.Window(col_off, row_off, min(block_width, cube.width - col_off),
+                                         min(block_height, cube.height - row_off))
+        data = cube.read(window=window)
+        values[members] = data[:, rows[members] - row_off, cols[members] - col_off].T
+    if 'weight' in df_pixels:
+        return apply_station_weights(values, df_pixels, cube.nodata, is_inside)
+    return values
+
+
 def get_lon_lat(df, station):
-    df_station = df[df.Name == station]
-    lon = df_station.Longitude.values[0]
-    lat = df_station.Latitude.values[0]
-    return lon, lat
+    """
+    Coordinates of a station looked up by its id (index of the station list) in the hash index of df
+    """
+    return df.at[station, 'Longitude'], df.at[station, 'Latitude']
+
+
+def get_station_file_name(station):
+    """
+    File name, without extension, of the weather files of a station. Derived from the unique station id so that
+    stations sharing a name do not overwrite each other's files
+    """
+    return re.sub(r'[^0-9A-Za-z_-]+', '_', str(station))
+
+
+def get_station_pixels(raster, df_stations, sampling='nearest'):
+    """
+    Projects every station to raster row/col in one vectorized call
+    :param raster: Opened raster whose grid geometry (crs and transform) is used
+    :param df_stations: Station list with Longitude and Latitude in degrees
+    :param sampling: nearest (default) pixel, or bilinear and area weights, see get_station_weights
+    :return: DataFrame indexed like df_stations with integer row and col columns
+    """
+    import rasterio
+    from pyproj import Transformer
+    if sampling != 'nearest':
+        return get_station_weights(raster, df_stations, sampling)
+    transformer = Transformer.from_crs("EPSG:4326", raster.crs, always_xy=True)
+    xx, yy = transformer.transform(df_stations.Longitude.values, df_stations.Latitude.values)
+    rows, cols = rasterio.transform.rowcol(raster.transform, xx, yy)
+    df_pixels = pd.DataFrame({'row': np.asarray(rows, dtype=np.int64).ravel(),
+                              'col': np.asarray(cols, dtype=np.int64).ravel()}, index=df_stations.index)
+    return df_pixels
+
+
+def get_station_weights(raster, df_stations, sampling='bilinear'):
+    """
+    Sparse sampling weights computed once per grid geometry, so a day is sampled with one weighted sum per station
+    :param df_stations: Station list with Longitude and Latitude in degrees, or for area sampling a GeoDataFrame of
+                polygons as returned by get_polygon_list
+    :param sampling: bilinear: the four pixel centers around each station, weighted by distance;
+                area: the pixels covered by each polygon, weighted by the area covered
+    :return: DataFrame of the non-zero weights in CSR order (rows of a station are contiguous) with pos (position of
+             the station in df_stations), row, col and weight columns, indexed by station. Stations without any pixel
+             get a single row outside the grid and receive nodata
+    """
+    import rasterio
+    from pyproj import Transformer
+    n_stations = len(df_stations)
+    if sampling == 'bilinear':
+        transformer = Transformer.from_crs("EPSG:4326", raster.crs, always_xy=True)
+        xx, yy = transformer.transform(df_stations.Longitude.values, df_stations.Latitude.values)
+        cols, rows = ~raster.transform * (np.asarray(xx, dtype=float), np.asarray(yy, dtype=float))
+        # fractional position relative to the pixel centers
+        cols, rows = np.asarray(cols) - 0.5, np.asarray(rows) - 0.5
+        col0, row0 = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+        fx, fy = cols - col0, rows - row0
+        pos = np.repeat(np.arange(n_stations), 4)
+        row = np.stack([row0, row0, row0 + 1, row0 + 1], axis=1).ravel()
+        col = np.stack([col0, col0 + 1, col0, col0 + 1], axis=1).ravel()
+        weight = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy], axis=1).ravel()
+    elif sampling == 'area':
+        import shapely
+        geometries = df_stations.to_crs(raster.crs).geometry.values
+        pos, row, col, weight = [], [], [], []
+        for i, geometry in enumerate(geometries):
+            window = rasterio.windows.from_bounds(*geometry.bounds, transform=raster.transform)
+            row_start, col_start = max(int(np.floor(window.row_off)), 0), max(int(np.floor(window.col_off)), 0)
+            row_stop = max(min(int(np.ceil(window.row_off + window.height)), raster.height), row_start)
+            col_stop = max(min(int(np.ceil(window.col_off + window.width)), raster.width), col_start)
+            rr, cc = np.mgrid[row_start:row_stop, col_start:col_stop]
+            rr, cc = rr.ravel(), cc.ravel()
+            x0, y0 = raster.transform * (cc, rr)
+            x1, y1 = raster.transform * (cc + 1, rr + 1)
+            cells = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+            area = shapely.area(shapely.intersection(cells, geometry))
+            if raster.crs.is_geographic:
+                # cells shrink towards the poles
+                area = area * np.cos(np.radians((y0 + y1) / 2))
+            covered = area > 0
+            if not covered.any():
+                rr, cc, area, covered = np.array([-1]), np.array([-1]), np.array([1.0]), np.array([True])
+            pos.append(np.full(covered.sum(), i))
+            row.append(rr[covered])
+            col.append(cc[covered])
+            weight.append(area[covered])
+        pos, row, col, weight = (np.concatenate(a) for a in (pos, row, col, weight))
+    else:
+        raise ValueError(f'Unsupported sampling {sampling}')
+    keep = weight > 0
+    # stations whose weights are all zero, e.g., outside the grid, keep one row so that every station has one
+    keep[np.r_[True, pos[1:] != pos[:-1]] & ~np.isin(pos, pos[keep])] = True
+    return pd.DataFrame({'pos': pos[keep], 'row': row[keep], 'col': col[keep], 'weight': weight[keep]},
+                        index=df_stations.index[pos[keep]])
+
+
+def apply_station_weights(pixel_values, df_weights, nodata=None, inside=None):
+    """
+    Weighted sum of the pixel values of every station, normalized by the weights of the valid pixels
+    :param pixel_values: Values gathered at the rows of df_weights, 1D, or 2D with one column per day
+    :param df_weights: Weights as returned by get_station_weights
+    :param nodata: Pixels holding this value are left out; stations without any valid pixel get it
+    :param inside: Boolean mask of the rows of df_weights inside the grid; the others are left out even when the
+                grid has no nodata value, so stations at the edge are normalized over their pixels in the grid
+    :return: Values per station, in the dtype of pixel_values
+    """
+    weight = df_weights.weight.values
+    pos = df_weights.pos.values
+    starts = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]])
+    valid = ~np.isnan(pixel_values)
+    if nodata is not None:
+        valid &= pixel_values != nodata
+    if pixel_values.ndim == 2:
+        weight = weight[:, None]
+        inside = None if inside is None else inside[:, None]
+    if inside is not None:
+        valid &= inside
+    total = np.add.reduceat(np.where(valid, pixel_values * weight, 0), starts, axis=0)
+    weight_sum = np.add.reduceat(valid * weight, starts, axis=0)
+    values = np.full(total.shape, 0 if nodata is None else nodata, dtype=pixel_values.dtype)
+    np.divide(total, weight_sum, out=values, where=weight_sum > 0, casting='unsafe')
+    return values
+
+
+def sample_band(band, df_pixels, nodata=None):
+    """
+    Gathers the value of every station pixel from a band array with fancy indexing
+    :param band: 2D array read from the raster
+    :param df_pixels: Station pixels as returned by get_station_pixels
+    :param nodata: Value given to stations falling outside the grid, same as raster.sample
+    :return: 1D array of values in the order of df_pixels
+    """
+    rows, cols = df_pixels.row.values, df_pixels.col.values
+    inside = (rows >= 0) & (rows < band.shape[0]) & (cols >= 0) & (cols < band.shape[1])
+    values = np.full(len(rows), 0 if nodata is None else nodata, dtype=band.dtype)
+    values[inside] = band[rows[inside], cols[inside]]
+    if 'weight' in df_pixels:
+        return apply_station_weights(values, df_pixels, nodata, inside)
+    return values
+
+
+def grid_fingerprint(raster):
+    """
+    Short hash of the grid geometry (crs, transform and shape) that station pixels depend on.
+    The crs is hashed as its PROJ string, which leaves out the authority and axis order the readers disagree on
+    (BilRaster resolves the PRISM .prj to EPSG:4269, rasterio to OGC:CRS83), so .bil, zipped, .tif and cube grids
+    of the same layout match.
+    """
+    text = f'{raster.crs.to_proj4()}|{tuple(raster.transform)}|{raster.shape}'
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def worker_pool(workers):
+    """
+    Process pool of the parallel extraction and conversion stages. Forked workers start with the metrics of the
+    parent, cleared by the initializer so they are not counted twice; each task returns its own with pop_metrics
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=pop_metrics)
+
+
+def read_day_grids(root_dir, year, scale, var_names, ymd, index, fingerprint, index_grid, reduce, stage):
+    """
+    Reads the grid of each variable of one day and reduces its band with reduce(band, index, nodata=nodata), timing
+    the open, index, read and `stage` stages. Run by the worker processes of extract_daily_vars and
+    extract_zonal_stats
+    :param index: Station pixels or zone labels of the grid with `fingerprint`
+    :param index_grid: index_grid(raster, fingerprint) builds the index in memory for a grid that does not match it
+    :return: List of the results of reduce, one per variable, and the metrics of the day, merged into the run metrics
+             by the parent process
+    """
+    results = []
+    for var_name in var_names:
+        with timed_stage('open', n_files=1):
+            raster_data = read_bil_file(main_path=root_dir, var_name=var_name, year=str(year), ymd=ymd, scale=scale)
+        if grid_fingerprint(raster_data) != fingerprint:
+            fingerprint = grid_fingerprint(raster_data)
+            with timed_stage('index'):
+                index = index_grid(raster_data, fingerprint)
+        with timed_stage('read') as counts:
+            band = raster_data.read(1)
+            counts['bytes'] = band.nbytes
+        with timed_stage(stage):
+            results.append(reduce(band, index, nodata=raster_data.nodata))
+        raster_data.close()
+    return results, pop_metrics()
+
+
+def get_station_index_path(csv_file_path, sampling='nearest'):
+    if sampling == 'nearest':
+        return f'{os.path.splitext(csv_file_path)[0]}_pixel_index.csv'
+    return f'{os.path.splitext(csv_file_path)[0]}_{sampling}_index.csv'
+
+
+def is_station_index_valid(df_index, df_stations, fingerprint, sampling='nearest'):
+    if df_index is None or ('weight' in df_index) != (sampling != 'nearest'):
+        return False
+    if 'pos' in df_index:
+        # weighted index, compared on the first row of each station
+        df_index = df_index[~df_index.pos.duplicated()]
+    if len(df_index) != len(df_stations):
+        return False
+    if not (df_index.fingerprint == fingerprint).all():
+        return False
+    if not (df_index.index.astype(str) == df_stations.index.astype(str)).all():
+        return False
+    return bool(np.allclose(df_index.Longitude.values, df_stations.Longitude.values) &
+                np.allclose(df_index.Latitude.values, df_stations.Latitude.values))
+
+
+@contextmanager
+def replace_file(file_path):
+    """
+    Yields a temporary path next to file_path and moves it onto file_path once the block has written it, so
+    concurrent jobs, e.g., array tasks sharing the station file, never read a partly written file
+    """
+    part_file = f'{file_path}.{os.getpid()}.part'
+    try:
+        yield part_file
+        os.replace(part_file, file_path)
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+
+def get_station_index(csv_file_path, df_stations, raster, df_index=None, sampling='nearest'):
+    """
+    Station to pixel index (row, col) saved next to the station file and reused across days, years and variables.
+    Bilinear and area sampling save their weights the same way, see get_station_weights
+    :param csv_file_path: Station file the index belongs to
+    :param df_stations: Station list read from csv_file_path
+    :param raster: Raster of the day; its grid fingerprint decides if the index is still valid
+    :param df_index: Optional index already in memory, returned as is when still valid
+    :param sampling: nearest (default), bilinear or area, see get_station_pixels
+    :return: DataFrame indexed like df_stations with Longitude, Latitude, row, col and fingerprint columns
+    """
+    fingerprint = grid_fingerprint(raster)
+    if is_station_index_valid(df_index, df_stations, fingerprint, sampling):
+        return df_index
+    index_file = get_station_index_path(csv_file_path, sampling)
+    if os.path.isfile(index_file):
+        try:
+            df_index = pd.read_csv(index_file, index_col=0)
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            # e.g., truncated by a job killed while writing it
+            print(f'Could not read station index {index_file}, rebuilding: {e}')
+        else:
+            if is_station_index_valid(df_index, df_stations, fingerprint, sampling):
+                return df_index
+            print(f'Station index {index_file} does not match the grid or the station list, rebuilding')
+    df_index = get_station_pixels(raster, df_stations, sampling)
+    pos = df_index.pos.values if 'pos' in df_index else np.arange(len(df_index))
+    df_index.insert(0, 'Longitude', df_stations.Longitude.values[pos])
+    df_index.insert(1, 'Latitude', df_stations.Latitude.values[pos])
+    df_index['fingerprint'] = fingerprint
+    try:
+        with replace_file(index_file) as part_file:
+            df_index.to_csv(part_file)
+    except OSError as e:
+        print(f'Could not save station index {index_file}: {e}')
+    return df_index
+
+
+def get_zone_list(main_path, zone_file, id_field):
+    """
+    Reads the polygons of a zonal extraction, e.g., counties or subbasins
+    :return: Path of the file and a GeoDataFrame indexed by the zone id (as text) with a Name column
+    """
+    import geopandas as gpd
+    zone_file_path = os.path.join(main_path, zone_file)
+    gdf = gpd.read_file(zone_file_path)
+    gdf.index = pd.Index(gdf[id_field].astype(str).values, name='Zone')
+    gdf['Name'] = gdf.index.values
+    return zone_file_path, gdf
+
+
+def get_zone_labels(raster, gdf_zones):
+    """
+    Rasterizes the zones once into labels of the pixels whose center falls inside them
+    :return: Flat pixel indices and zone labels (0 to zones - 1), sorted by label
+    """
+    from rasterio import features
+    shapes = zip(gdf_zones.to_crs(raster.crs).geometry.values, range(1, len(gdf_zones) + 1))
+    label_grid = features.rasterize(shapes, out_shape=(raster.height, raster.width), transform=raster.transform,
+                                    fill=0, dtype='int32')
+    pixels = np.flatnonzero(label_grid)
+    labels = label_grid.ravel()[pixels] - 1
+    order = np.argsort(labels, kind='stable')
+    return pixels[order], labels[order]
+
+
+def zones_digest(gdf_zones):
+    """
+    Hash of the zone geometries and their crs, so edited polygons do not reuse the labels of the old ones even when
+    the zone ids are unchanged
+    """
+    sha1 = hashlib.sha1(str(gdf_zones.crs.to_wkt() if gdf_zones.crs is not None else '').encode())
+    for wkb in gdf_zones.geometry.to_wkb():
+        sha1.update(b'' if wkb is None else wkb)
+    return sha1.hexdigest()
+
+
+def get_zone_index(zone_file_path, gdf_zones, raster, zone_index=None):
+    """
+    Zone label grid saved next to the zone file for each grid fingerprint, and reused across days, years and variables
+    as long as the zone ids and geometries are unchanged
+    :param zone_index: Optional index already in memory, returned as is when still valid
+    :return: Dictionary with pixels, labels, ids, digest of the zones and fingerprint
+    """
+    fingerprint = grid_fingerprint(raster)
+    ids = np.asarray(gdf_zones.index.astype(str), dtype=str)
+    digest = zones_digest(gdf_zones)
+    if zone_index is not None and zone_index['fingerprint'] == fingerprint and \
+            np.array_equal(zone_index['ids'], ids) and zone_index.get('digest') == digest:
+        return zone_index
+    index_file = f'{os.path.splitext(zone_file_path)[0]}_zones_{fingerprint}.npz'
+    if os.path.isfile(index_file):
+        try:
+            with np.load(index_file) as data:
+                zone_index = {key: data[key] for key in ['pixels', 'labels', 'ids']}
+                # indexes saved before the digest was recorded are rebuilt once
+                zone_index['digest'] = str(data['digest']) if 'digest' in data else None
+            zone_index['fingerprint'] = fingerprint
+            if np.array_equal(zone_index['ids'], ids) and zone_index['digest'] == digest:
+                return zone_index
+            print(f'Zone index {index_file} does not match the zones, rebuilding')
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f'Could not read zone index {index_file}, rebuilding: {e}')
+    pixels, labels = get_zone_labels(raster, gdf_zones)
+    zone_index = {'pixels': pixels, 'labels': labels, 'ids': ids, 'digest': digest, 'fingerprint': fingerprint}
+    try:
+        with replace_file(index_file) as part_file, open(part_file, 'wb') as f:
+            np.savez(f, pixels=pixels, labels=labels, ids=ids, digest=digest)
+    except OSError as e:
+        print(f'Could not save zone index {index_file}: {e}')
+    return zone_index
+
+
+def zonal_stats(band, zone_index, stats=('mean',), nodata=None):
+    """
+    Reduces a band over every zone with bincount and reduceat over the pixels sorted by zone
+    :param band: 2D array read from the raster
+    :param zone_index: Zone index as returned by get_zone_index
+    :param stats: Any of mean, min, max, sum and count
+    :param nodata: Pixels holding this value are left out; zones without any valid pixel get it
+    :return: Dictionary of 1D arrays, one value per zone in the order of the zone ids
+    """
+    n_zones = len(zone_index['ids'])
+    labels = zone_index['labels']
+    values = band.ravel()[zone_index['pixels']].astype('float64')
+    valid = ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+    fill = np.nan if nodata is None else nodata
+    count = np.bincount(labels[valid], minlength=n_zones)
+    results = {}
+    for stat in stats:
+        if stat == 'count':
+            results[stat] = count
+            continue
+        if stat in ['mean', 'sum']:
+            total = np.bincount(labels[valid], weights=values[valid], minlength=n_zones)
+            result = total / np.maximum(count, 1) if stat == 'mean' else total
+        elif stat in ['min', 'max']:
+            # invalid pixels are pushed out of the reduction, zones without pixels are filled below
+            reduce = np.minimum if stat == 'min' else np.maximum
+            masked = np.where(valid, values, np.inf if stat == 'min' else -np.inf)
+            starts = np.searchsorted(labels, np.arange(n_zones))
+            present = starts < np.searchsorted(labels, np.arange(n_zones), side='right')
+            result = np.zeros(n_zones)
+            result[present] = reduce.reduceat(masked, starts[present])
+        else:
+            raise ValueError(f'Unsupported statistic {stat}')
+        result[count == 0] = fill
+        results[stat] = result.astype(band.dtype) if np.issubdtype(band.dtype, np.floating) else result
+    return results
 
 
 def get_station_list_by_attribute(data_dir, save_dir, station_file, var_name):
@@ -166,20 +887,42 @@ def get_station_list_by_attribute(data_dir, save_dir, station_file, var_name):
     return df_stations
 
 
+def assign_stations(gdf, df_stations, gdf_counties=None, state_field='NAME', county_field='NAMELSAD'):
+    """
+    Assigns every station to the state, and optionally the county, containing it. All station points are queried
+    at once against the STRtree spatial index of the polygons instead of clipping the stations state by state
+    :param gdf: States, e.g., tl_2021_us_state.shp
+    :param df_stations: Stations with Longitude and Latitude in the coordinate system of gdf
+    :param gdf_counties: Optional. Counties, e.g., tl_2021_us_county.shp
+    :param state_field: Attribute of gdf holding the state name
+    :param county_field: Attribute of gdf_counties holding the county name
+    :return: GeoDataFrame of the stations with a State (and County) column, NaN for stations outside all polygons
+    """
+    import geopandas as gpd
+    gdf_stations = gpd.GeoDataFrame(df_stations,
+                                    geometry=gpd.points_from_xy(df_stations.Longitude, df_stations.Latitude),
+                                    crs=gdf.crs)
+    for polygons, field, column in [(gdf, state_field, 'State'), (gdf_counties, county_field, 'County')]:
+        if polygons is None:
+            continue
+        if polygons.crs != gdf_stations.crs:
+            polygons = polygons.to_crs(gdf_stations.crs)
+        idx_station, idx_polygon = polygons.sindex.query(gdf_stations.geometry.values, predicate='intersects')
+        # Stations on a shared boundary intersect both polygons and are kept in the first one, like in the shapefile
+        order = np.lexsort((idx_polygon, idx_station))
+        idx_station, first = np.unique(idx_station[order], return_index=True)
+        names = np.full(len(gdf_stations), np.nan, dtype=object)
+        names[idx_station] = polygons[field].values[idx_polygon[order][first]]
+        gdf_stations[column] = names
+    return gdf_stations
+
+
 def get_list_by_state(gdf, state_name, df_stations, save_dir, var_name):
-    crs = gdf.crs.to_epsg()
     gdf_STATE = gdf[gdf.NAME == state_name]
     shapefile = os.path.join(save_dir, f'{state_name}.shp')
     gdf_STATE.to_file(shapefile)
-    x1, y1, x2, y2 = gdf_STATE.geometry.total_bounds
-    df_stations_state = df_stations[
-        (df_stations.Longitude >= x1) & (df_stations.Longitude <= x2) & (df_stations.Latitude >= y1) & (
-                df_stations.Latitude <= y2)]
-    gdf_stations = gpd.GeoDataFrame(df_stations_state,
-                                    geometry=gpd.points_from_xy(df_stations_state.Longitude,
-                                                                df_stations_state.Latitude),
-                                    crs=f"EPSG:{crs}")
-    gdf_state = gpd.clip(gdf_stations, gdf_STATE, keep_geom_type=False)
+    gdf_stations = assign_stations(gdf_STATE, df_stations)
+    gdf_state = gdf_stations[gdf_stations.State == state_name].drop(columns='State')
     shapefile = os.path.join(save_dir, f'{state_name}_PRISM_{var_name}.shp')
     gdf_state.to_file(shapefile)
     df_state = pd.DataFrame(gdf_state.drop(columns='geometry'))
@@ -187,32 +930,223 @@ def get_list_by_state(gdf, state_name, df_stations, save_dir, var_name):
     return gdf_STATE, gdf_state, df_state
 
 
+def get_lists_by_state(gdf_US, data_dir, state_names, save_dir, station_file, var_names, gdf_counties=None,
+                       county_field='NAMELSAD', save_shapefiles=True):
+    """
+    Batch version of get_list for several states and variables. Each station list is read once (a shared
+    station_file only once), the unique station locations of all variables are assigned to their state (and county)
+    in a single spatial join, and the lists are then split per state and variable. The files written are those of
+    get_list_by_state, with the boundary of each state written once
+    :param gdf_US: States, e.g., tl_2021_us_state.shp
+    :param state_names: List of states (NAME of gdf_US), or None for every state holding stations
+    :param var_names: List of variables, e.g., ['ppt', 'tmin', 'tmax']
+    :param gdf_counties: Optional. Counties; adds a County column to the state lists
+    :param county_field: Attribute of gdf_counties holding the county name
+    :param save_shapefiles: Write the state boundaries and station shapefiles besides the csv lists
+    :return: Dictionary of the US station list per variable, and dictionary of (gdf_STATE, gdf_state, df_state), as
+    returned by get_list_by_state, per (state_name, var_name)
+    """
+    import geopandas as gpd
+    stations = {}
+    df_stations = None
+    for var_name in var_names:
+        if station_file is None or df_stations is None:
+            _, df_stations = get_station_list(data_dir, station_file, var_name)
+        df_stations.to_csv(os.path.join(save_dir, f'US_Stations_{var_name}.csv'))
+        stations[var_name] = df_stations
+    # Stations shared by the variables are joined once and looked up by location
+    df_coords = pd.concat([df[['Longitude', 'Latitude']] for df in stations.values()]).drop_duplicates()
+    gdf_coords = assign_stations(gdf_US, df_coords, gdf_counties=gdf_counties, county_field=county_field)
+    columns = ['State'] if gdf_counties is None else ['State', 'County']
+    coord_keys = pd.MultiIndex.from_frame(df_coords)
+    if state_names is None:
+        state_names = sorted(gdf_coords.State.dropna().unique())
+    gdf_states = {}
+    for state_name in state_names:
+        gdf_states[state_name] = gdf_US[gdf_US.NAME == state_name]
+        if save_shapefiles:
+            gdf_states[state_name].to_file(os.path.join(save_dir, f'{state_name}.shp'))
+    lists = {}
+    for var_name, df_stations in stations.items():
+        pos = coord_keys.get_indexer(pd.MultiIndex.from_frame(df_stations[['Longitude', 'Latitude']]))
+        df_assigned = df_stations.copy()
+        for column in columns:
+            df_assigned[column] = gdf_coords[column].values[pos]
+        for state_name in state_names:
+            df_state = df_assigned[df_assigned.State == state_name].drop(columns='State')
+            gdf_state = gpd.GeoDataFrame(df_state, geometry=gpd.points_from_xy(df_state.Longitude, df_state.Latitude),
+                                         crs=gdf_US.crs)
+            if save_shapefiles:
+                gdf_state.to_file(os.path.join(save_dir, f'{state_name}_PRISM_{var_name}.shp'))
+            df_state.to_csv(os.path.join(save_dir, f'{state_name}_Stations_{var_name}.csv'))
+            lists[(state_name, var_name)] = (gdf_states[state_name], gdf_state, df_state)
+    return stations, lists
+
+
 def get_list(gdf_US, data_dir, state_name, save_dir, station_file, var_name):
-    df_stations = get_station_list_by_attribute(data_dir, save_dir, station_file, var_name)
-    gdf_STATE, gdf_station, df_state = get_list_by_state(gdf_US, state_name, df_stations, save_dir, var_name)
-    return df_stations, gdf_STATE, gdf_station, df_state
+    stations, lists = get_lists_by_state(gdf_US, data_dir, [state_name], save_dir, station_file, [var_name])
+    gdf_STATE, gdf_station, df_state = lists[(state_name, var_name)]
+    return stations[var_name], gdf_STATE, gdf_station, df_state
 
 
-def read_import_data(data_dir, state_name, attribute, year):
+def get_import_file(data_dir, state_name, attribute, year, file_format=None):
+    '''
+    Path of an imported annual time series
+    :param file_format: csv or parquet. If None, the parquet file when it exists, otherwise the csv file
+    '''
+    if state_name is not None:
+        data_dir = os.path.join(data_dir, state_name)
+    file_path = os.path.join(data_dir, f'Prism_{attribute}_{year}')
+    if file_format is None:
+        file_format = 'parquet' if os.path.isfile(f'{file_path}.parquet') else 'csv'
+    return f'{file_path}.{file_format}'
+
+
+def read_import_data(data_dir, state_name, attribute, year, file_format=None, usecols=None):
     '''
     Reads imported annual time series
     :param data_dir:
     :param state_name:
     :param attribute:
     :param year:
+    :param file_format: csv or parquet. If None, the parquet file is read when it exists, otherwise the csv file
+    :param usecols: Optional. Columns to read, e.g., only the station information
     :return:
     '''
-    file = f'Prism_{attribute}_{year}.csv'
-    if state_name==None:
-        file_path = os.path.join(data_dir, file)
+    file_path = get_import_file(data_dir, state_name, attribute, year, file_format)
+    if file_path.endswith('.parquet'):
+        # Same layout as the csv: station id as first column followed by information and daily values
+        columns = None if usecols is None else [c for c in usecols if c != 'Station']
+        df = pd.read_parquet(file_path, columns=columns).reset_index()
+    else:
+        df = pd.read_csv(file_path, usecols=usecols)
+    return df
+
+
+def get_import_dates(data_dir, state_name, attribute, year, file_format=None):
+    '''
+    Lists the days of an imported annual time series (wide layout) without loading its values
+    :return: Dates as YYYY-MM-DD strings
+    '''
+    file_path = get_import_file(data_dir, state_name, attribute, year, file_format)
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        columns = pq.read_schema(file_path).names
+    else:
+        columns = pd.read_csv(file_path, nrows=0).columns
+    info_cols = ['Station', 'stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)', '__index_level_0__']
+    return [c for c in columns if c not in info_cols]
+
+
+def get_weather_dates(file_path):
+    '''
+    Lists the dates of a concatenated daily series as YYYY-MM-DD strings, reading only its index
+    '''
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(file_path)
+        index_columns = schema.pandas_metadata.get('index_columns', []) if schema.pandas_metadata else []
+        dates = pq.read_table(file_path, columns=index_columns[:1]).column(0).to_pandas()
+    else:
+        dates = pd.read_csv(file_path, usecols=[0]).iloc[:, 0]
+    return list(pd.to_datetime(dates).dt.strftime('%Y-%m-%d'))
+
+
+def get_weather_stations(file_path):
+    '''
+    Lists the station columns of a concatenated daily series without loading its values
+    '''
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(file_path)
+        index_columns = schema.pandas_metadata.get('index_columns', []) if schema.pandas_metadata else []
+        return pd.Index([name for name in schema.names if name not in index_columns])
+    return pd.read_csv(file_path, index_col=0, nrows=0).columns
+
+
+def widen_float32(df):
+    """
+    Converts the float32 columns of a parquet table to float64 through their shortest decimal text, which is what the
+    csv tables hold, so both formats give the same values and the .dly files are rounded the same from either.
+    A plain cast would keep the binary float32 value, e.g., 157.02499 for 157.025, and round ties differently
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    columns = [column for column in df.columns if df[column].dtype == np.float32]
+    if len(columns) == 0:
+        return df
+    values = df[columns].to_numpy()
+    text = pc.cast(pa.array(values.ravel()), pa.string())
+    values = pc.cast(text, pa.float64()).to_numpy(zero_copy_only=False).reshape(values.shape)
+    df = df.copy()
+    df[columns] = values
+    return df
+
+
+def read_weather_data(file_path, stations=None):
+    '''
+    Reads a concatenated daily series (dates x stations) written by concatenate_data.py as csv or parquet
+    :param stations: Optional. Only these station columns are loaded (column projection), in this order
+    :return: DataFrame with a DatetimeIndex and float64 values, the same from either format
+    '''
+    if file_path.endswith('.parquet'):
+        df = pd.read_parquet(file_path, columns=None if stations is None else list(stations))
+        df = widen_float32(df)
+    elif stations is None:
+        df = pd.read_csv(file_path, index_col=0)
     else:
-        data_dir = os.path.join(data_dir, state_name)  
-        file_path = os.path.join(data_dir, file)
-    df = pd.read_csv(file_path)
+        positions = pd.Index(get_weather_stations(file_path)).get_indexer(stations)
+        if (positions < 0).any():
+            raise KeyError(f'Stations not found in {file_path}: {list(pd.Index(stations)[positions < 0])}')
+        df = pd.read_csv(file_path, index_col=0, usecols=[0] + sorted(set(positions + 1)))
+        df = df[list(stations)]
+    df.index = pd.to_datetime(df.index)
     return df
 
 
+def csv_to_parquet(csv_path, parquet_path, chunk_rows=1000):
+    """
+    Converts a concatenated daily series from csv to parquet in chunks of rows, parsing the text once and holding only
+    one chunk in memory. Values stay float64, the values the csv series is read as, so reading the parquet file with
+    read_weather_data gives the same frame
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    dtypes = {station: 'float64' for station in get_weather_stations(csv_path)}
+    writer = None
+    try:
+        for chunk in pd.read_csv(csv_path, index_col=0, dtype=dtypes, chunksize=chunk_rows):
+            table = pa.Table.from_pandas(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return parquet_path
+
+
+def write_table(df, file_path, file_format='csv'):
+    '''
+    Writes df to `file_path` plus the extension of `file_format` (csv or parquet) and returns the full path
+    '''
+    with timed_stage('write', n_files=1) as counts:
+        if file_format == 'parquet':
+            # pyarrow is required; parquet column names must be strings
+            df = df.set_axis([str(c) for c in df.columns], axis=1)
+            df.to_parquet(f'{file_path}.parquet')
+            file_path = f'{file_path}.parquet'
+        elif file_format == 'csv':
+            df.to_csv(f'{file_path}.csv')
+            file_path = f'{file_path}.csv'
+        else:
+            raise ValueError(f'Unsupported file format {file_format}')
+        counts['bytes'] = os.path.getsize(file_path)
+    return file_path
+
+
 def write_line_ff(df, i):
+    import fortranformat as ff
     yr = int(df.iloc[i, 0])
     mm = int(df.iloc[i, 1])
     dd = int(df.iloc[i, 2])
@@ -250,14 +1184,62 @@ def write_line_ff(df, i):
     return line_write
 
 
+def format_fortran_i(values, width):
+    """
+    Fortran Iw editing of a whole column, identical to fortranformat
+    """
+    strings = [f'{int(v):{width}d}' for v in values]
+    return [s if len(s) <= width else '*' * width for s in strings]
+
+
+def format_fortran_f(values, width, decimals):
+    """
+    Fortran Fw.d editing of a whole column, identical to fortranformat: the exact value is rounded half away from
+    zero, fields that do not fit are filled with '*', and NaN/Inf are spelled as fortranformat does
+    """
+    values = np.asarray(values, dtype=float)
+    fmt = f'%{width}.{decimals}f'
+    # -0.0 is written without sign
+    strings = [fmt % v for v in np.where(values == 0, 0.0, values).tolist()]
+    # Python rounds exact decimal ties (e.g., 0.25 in F6.1) half to even; only those can differ from Fortran
+    scaled = np.abs(values) * 2 * 10 ** decimals
+    with np.errstate(invalid='ignore'):
+        candidates = np.flatnonzero((scaled == np.floor(scaled)) & (np.mod(scaled, 2) == 1))
+    for i in candidates:
+        exact = Decimal(float(values[i]))
+        if abs(exact) * 2 * 10 ** decimals % 2 == 1:
+            strings[i] = f'{exact.quantize(Decimal(10) ** -decimals, rounding=ROUND_HALF_UP):>{width}}'
+    for i in np.flatnonzero(~np.isfinite(values)):
+        if np.isnan(values[i]):
+            strings[i] = 'NaN'.rjust(width)
+        else:
+            sign = '-' if values[i] < 0 else '+'
+            strings[i] = (sign + ('Infinity' if width > 8 else 'Inf')).rjust(width)
+    return [s if len(s) <= width else '*' * width for s in strings]
+
+
+def format_fortran_a(values, width):
+    strings = [str(v) for v in values]
+    return [s.rjust(width) if len(s) <= width else s[:width] for s in strings]
+
+
 def convert2dly(df, file):
-    f_w = open(file, 'w')
-    f_w.close()
-    for i in range(df.shape[0]):
-        f_a = open(file, 'a')
-        line_write = write_line_ff(df, i)
-        f_a.writelines(line_write + '\n')
-        f_a.close()
+    """
+    Writes df in the daily weather (.dly) layout of write_line_ff, column by column and in one buffered write.
+    The first three columns are year, month and day; srad, rhum and wind are left blank when not in df.
+    """
+    n_days = df.shape[0]
+    blank = [' ' * 6] * n_days
+    fields = [format_fortran_i(df.iloc[:, 0], 6), format_fortran_i(df.iloc[:, 1], 4),
+              format_fortran_i(df.iloc[:, 2], 4),
+              format_fortran_f(df['srad'], 6, 1) if 'srad' in df.columns else blank,
+              format_fortran_f(df['tmax'], 6, 1), format_fortran_f(df['tmin'], 6, 1),
+              format_fortran_f(df['ppt'], 6, 2),
+              format_fortran_f(df['rhum'], 6, 1) if 'rhum' in df.columns else blank,
+              format_fortran_f(df['wind'], 6, 1) if 'wind' in df.columns else blank,
+              format_fortran_a(df.index, 25)]
+    with open(file, 'w') as f:
+        f.write(''.join(''.join(line) + '\n' for line in zip(*fields)))
 
 
 def create_list_month_files(year):
@@ -267,28 +1249,94 @@ def create_list_month_files(year):
     return month_list
 
 
-def split_month_folder(root_dir, scale, var_name, year):
+# Ways split_month_folder places a file into its month folder. hardlink and symlink add no data on disk, move
+# empties the year folder
+SPLIT_MODES = ['copy', 'hardlink', 'symlink', 'move']
+
+
+def get_month_index(files, year):
+    """
+    Groups file names by the month of year in their name, in one pass over the listing
+    :return: Dictionary of month (YYYYMM) to the names of its files, for the months having files
+    """
+    pattern = re.compile(f'{year}(0[1-9]|1[0-2])')
+    month_index = {}
+    for file in files:
+        match = pattern.search(file)
+        if match is not None:
+            month_index.setdefault(match.group(0), []).append(file)
+    return month_index
+
+
+def place_file(src, dst, mode='hardlink'):
+    """
+    Places src at dst by copy, hard link, symbolic link or move, replacing dst. A hard link across drives or on a file
+    system without links falls back to a copy
+    :return: Mode actually used
+    """
+    if os.path.lexists(dst):
+        # lstat so that a symbolic link left by an earlier split is replaced rather than taken for the hard link
+        if mode == 'hardlink' and os.path.samestat(os.lstat(src), os.lstat(dst)):
+            return mode
+        os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            mode = 'copy'
+    if mode == 'copy':
+        shutil.copyfile(src, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'move':
+        os.replace(src, dst)
+    else:
+        raise ValueError(f'Unsupported mode {mode}, use one of {", ".join(SPLIT_MODES)}')
+    return mode
+
+
+def split_month_folder(root_dir, scale, var_name, year, mode='hardlink'):
+    """
+    Places the files of Prism/Variables/<scale>/<var_name>/<year> into one folder per month, <var_name>/<YYYYMM>
+    :param mode: copy, hardlink (default, copies when linking is not possible), symlink or move
+    :return: Number of files placed per month
+    """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f'Unsupported mode {mode}, use one of {", ".join(SPLIT_MODES)}')
     # Detect and create read and save directory
     root_dir = os.path.join(root_dir, 'Prism/Variables')
     sub_dir = os.path.join(root_dir, scale)
     sub_dir1 = os.path.join(sub_dir, var_name)
     sub_dir2 = os.path.join(sub_dir1, str(year))
-    files = os.listdir(sub_dir2)
-    month_list = create_list_month_files(year)
-    for ym in month_list:
-        yr_files = []
-        for file in files:
-            if ym in file:
-                yr_files.append(file)
-            else:
-                continue
-        del file
+    if not os.path.isdir(sub_dir2):
+        print(f'Skipped {year}: {sub_dir2} does not exist\n', end='')
+        return {}
+    month_index = get_month_index(os.listdir(sub_dir2), year)
+    n_files, copied = {}, 0
+    for ym in create_list_month_files(year):
         # Create folder to save split file
         copy_dir = create_save_folder(root_dir=sub_dir1, sub_dir=ym)
-        # Copy monthly folder into  the  folder
-        for file in yr_files:
-            shutil.copyfile(f'{sub_dir2}/{file}', f'{copy_dir}/{file}')
-            print(f'Copied {file} into {copy_dir}.')
-        del file
-    print(f'Done for {year}')
+        files = month_index.get(ym, [])
+        with timed_stage(f'split_{mode}', n_files=len(files)):
+            for file in files:
+                copied += place_file(os.path.join(sub_dir2, file), os.path.join(copy_dir, file), mode) == 'copy'
+        n_files[ym] = len(files)
+    fallback = f', {copied} copied where linking failed' if mode == 'hardlink' and copied else ''
+    # one write per line, so the lines of years split in parallel threads do not interleave
+    print(f'Done for {year}: {sum(n_files.values())} files split into {len(n_files)} month folders by {mode}'
+          f'{fallback}\n', end='')
+    return n_files
+
+
+def split_month_folders(root_dir, scale, var_name, years, mode='hardlink', workers=1):
+    """
+    Runs split_month_folder over years, in threads when workers > 1 since the work is file system calls
+    :return: Dictionary of year to the number of files placed per month
+    """
+    split_year = partial(split_month_folder, root_dir, scale, var_name, mode=mode)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(years, executor.map(split_year, years)))
+    return {year: split_year(year) for year in years}
 
@@ -0,0 +1,418 @@
+"""
+    Program: Benchmark of the PRISM pipeline on synthetic grids and stations
+    Author: Mahesh Lal Maskey, Ph.D. in Hydrologic Sciences
+    Affiliations: USDA-ARS, Sustainable Water Management Research Unit, Stoneville/Leland MS
+                  University of California, Davis, Department of Land, Air, and Water Resources
+    E-mail: mahesh.maskey@usda.gov/mmaskey@ucdavis.edu
+"""
+# Syntax: python benchmark.py --work_dir='path/to/benchmark_dir' --days=30 --stations=2000 --workers=4
+# --baseline='path/to/benchmark_dir/Results/benchmark_<time>.json'
+
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zipfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from Utility import create_save_folder
+from Utility import get_peak_memory
+from Utility import merge_metrics
+from Utility import pop_metrics
+
+# Layout of the PRISM 4 km grids: upper left pixel center, pixel size and shape
+ULXMAP, ULYMAP, DIM = -125.0, 49.9166666666687, 0.0416666666667
+NROWS, NCOLS = 621, 1405
+PRJ_NAD83 = ('GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,'
+             '298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+STAGES = ['startup', 'download', 'extract', 'concatenate', 'convert']
+# Command line tools timed by the startup stage, and the heavy modules whose import they should not pay for
+CLI_SCRIPTS = ['main_download.py', 'main_extract_PRISM_daily.py', 'build_cube.py', 'extract_zonal_stats.py',
+               'concatenate_data.py', 'convert_weather.py', 'split_monthly_folders.py']
+HEAVY_MODULES = ['geopandas', 'rasterio', 'pyproj', 'fortranformat', 'osgeo', 'shapely']
+# Runs a script with --help and lists the heavy modules it imported
+STARTUP_CODE = '''import io, runpy, sys
+sys.argv = [sys.argv[1], '--help']
+sys.stdout = io.StringIO()
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print('modules:', *[name for name in {heavy} if name in sys.modules])
+'''
+
+
+def write_synthetic_zip(zip_file_path, var_name, ymd, values):
+    """
+    Writes one daily grid as a PRISM archive: .bil with its .hdr and .prj sidecars
+    :param values: float32 array of shape (nrows, ncols), -9999 outside the domain
+    """
+    stem = f'PRISM_{var_name}_stable_4kmD2_{ymd}_bil'
+    nrows, ncols = values.shape
+    header = (f'BYTEORDER      I\nLAYOUT         BIL\nNROWS          {nrows}\nNCOLS          {ncols}\n'
+              f'NBANDS         1\nNBITS          32\nBANDROWBYTES   {ncols * 4}\nTOTALROWBYTES  {ncols * 4}\n'
+              f'PIXELTYPE      FLOAT\nULXMAP         {ULXMAP}\nULYMAP         {ULYMAP}\nXDIM           {DIM}\n'
+              f'YDIM           {DIM}\nNODATA         -9999\n')
+    with zipfile.ZipFile(f'{zip_file_path}.part', 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'{stem}.bil', values.astype('<f4').tobytes())
+        zf.writestr(f'{stem}.hdr', header)
+        zf.writestr(f'{stem}.prj', PRJ_NAD83)
+    os.replace(f'{zip_file_path}.part', zip_file_path)
+
+
+def make_synthetic_grids(server_dir, var_names, year, days, nrows=NROWS, ncols=NCOLS):
+    """
+    Lays out synthetic daily archives like the PRISM repository, daily/<variable>/<year>/<archive>. Archives already
+    generated are kept, so repeated benchmarks of the same configuration only pay for this once
+    :return: Number of archives and their size in bytes
+    """
+    dates = pd.date_range(f'{year}-01-01', periods=days).strftime('%Y%m%d')
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    # Smooth field with a corner outside the domain, so values compress like real grids and nodata is sampled
+    base = (np.sin(rows / 40.0) + np.cos(cols / 60.0)).astype('float32')
+    outside = (rows / nrows + cols / ncols) < 0.15
+    n_bytes = 0
+    for v, var_name in enumerate(var_names):
+        var_dir = create_save_folder(server_dir, f'daily/{var_name}/{year}')
+        rng = np.random.default_rng(v)
+        for k, ymd in enumerate(dates):
+            zip_file_path = os.path.join(var_dir, f'PRISM_{var_name}_stable_4kmD2_{ymd}_bil.zip')
+            if not os.path.isfile(zip_file_path):
+                values = base * 5 + 10 * v + k % 30 + rng.random((nrows, ncols), dtype='float32')
+                values = np.round(values, 2).astype('float32')
+                values[outside] = -9999
+                write_synthetic_zip(zip_file_path, var_name, ymd, values)
+            n_bytes += os.path.getsize(zip_file_path)
+    return len(dates) * len(var_names), n_bytes
+
+
+def make_synthetic_stations(file_path, n_stations, nrows=NROWS, ncols=NCOLS, seed=0):
+    """
+    Writes a station list with unique ids scattered over the grid, a few of them in the nodata corner
+    """
+    rng = np.random.default_rng(seed)
+    x_min, y_max = ULXMAP - DIM / 2, ULYMAP + DIM / 2
+    df_stations = pd.DataFrame({'Station': [f'BM{i:06d}' for i in range(n_stations)],
+                                'Name': [f'Benchmark {i % 100}' for i in range(n_stations)],
+                                'Longitude': rng.uniform(x_min, x_min + ncols * DIM, n_stations),
+                                'Latitude': rng.uniform(y_max - nrows * DIM, y_max, n_stations),
+                                'Elevation(m)': rng.uniform(0, 3000, n_stations).round(1),
+                                'Network': 'SYN', 'stnid': [f'SYN{i}' for i in range(n_stations)]})
+    df_stations.to_csv(file_path, index=False)
+    return file_path
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    # keep-alive like the PRISM server, so the persistent connections of the downloader are exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(server_dir):
+    """
+    Serves server_dir over HTTP on a free local port from a background thread
+    :return: Server and its url
+    """
+    handler = functools.partial(QuietHandler, directory=server_dir)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_startup(scripts=CLI_SCRIPTS, repeats=5):
+    """
+    Times the start of each command line tool in a fresh interpreter, up to its argument parsing (--help), which is
+    the fixed cost paid by every job of an array
+    :param repeats: Number of starts per script; the median is reported
+    :return: Dictionary of stage results per script, with the heavy modules imported at start
+    """
+    src_dir = os.path.dirname(os.path.realpath(__file__))
+    code = STARTUP_CODE.format(heavy=HEAVY_MODULES)
+    results = {}
+    for script in scripts:
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            process = subprocess.run([sys.executable, '-c', code, os.path.join(src_dir, script)],
+                                     capture_output=True, text=True, cwd=src_dir)
+            times.append(time.perf_counter() - t0)
+        lines = [line for line in process.stdout.splitlines() if line.startswith('modules:')]
+        modules = lines[0].split()[1:] if lines else None
+        results[f'startup_{os.path.splitext(script)[0]}'] = {'seconds': round(float(np.median(times)), 6),
+                                                              'min_seconds': round(min(times), 6),
+                                                              'modules': modules}
+        print(f'{script:<32}{np.median(times):>10.3f} seconds  imports {modules}')
+    return results
+
+
+def time_stage(verbose, function, *args, **kwargs):
+    """
+    Runs one pipeline stage in the current process
+    :return: Seconds, metrics of its sub stages and peak memory of the process and of its finished workers
+    """
+    pop_metrics()
+    output = io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        function(*args, **kwargs)
+    return time.perf_counter() - t0, pop_metrics(), get_peak_memory()
+
+
+def stage_process(connection, verbose, function, args, kwargs):
+    """
+    Body of the child process of run_stage, sends back the result of time_stage or the traceback of the stage
+    """
+    try:
+        connection.send((time_stage(verbose, function, *args, **kwargs), None))
+    except BaseException:
+        connection.send((None, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def run_stage(stage, results, verbose, function, *args, **kwargs):
+    """
+    Runs one pipeline stage and records its wall time, peak memory and the metrics of its sub stages (see
+    Utility.timed_stage). The stage runs in a forked child process, as the peak resident memory of a process never
+    goes down: the peak is then that of the stage and its workers only, not of the heaviest stage run before it.
+    Where fork is not available, the stage runs in this process and the peak is that of the whole run so far
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        seconds, metrics, peak_memory = time_stage(verbose, function, *args, **kwargs)
+    else:
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=stage_process, args=(sender, verbose, function, args, kwargs))
+        process.start()
+        sender.close()
+        try:
+            value, error = receiver.recv()
+        except EOFError:
+            # killed before sending anything, e.g., out of memory
+            value, error = None, None
+        process.join()
+        if value is None and error is None:
+            error = f'process exited with code {process.exitcode}'
+        if error is not None:
+            raise RuntimeError(f'Stage {stage} failed: {error}')
+        seconds, metrics, peak_memory = value
+    results[stage] = {'seconds': round(seconds, 6), 'peak_memory_mb': peak_memory, 'metrics': metrics}
+    print(f'{stage:<34}{seconds:>10.3f} seconds')
+
+
+def combine_stages(results, stage, parts):
+    """
+    Replaces the results of a stage run once per variable by their total, with the highest peak memory of the parts
+    """
+    metrics = {}
+    for part in parts:
+        merge_metrics(results[part]['metrics'], into=metrics)
+    peaks = [results[part]['peak_memory_mb'] for part in parts if results[part]['peak_memory_mb'] is not None]
+    results[stage] = {'seconds': round(sum(results.pop(part)['seconds'] for part in parts), 6),
+                      'peak_memory_mb': max(peaks) if peaks else None, 'metrics': metrics}
+    return results[stage]
+
+
+def add_throughput(result, station_days=None, files=None, n_bytes=None):
+    seconds = result['seconds']
+    if station_days is not None:
+        result['station_days'] = int(station_days)
+        result['station_days_per_second'] = round(station_days / seconds, 1)
+    if files is not None:
+        result['files'] = int(files)
+        result['files_per_second'] = round(files / seconds, 2)
+    if n_bytes is not None:
+        result['mb'] = round(n_bytes / 1e6, 3)
+        result['mb_per_second'] = round(n_bytes / 1e6 / seconds, 3)
+
+
+def compare_results(results, baseline_file, tolerance):
+    """
+    Compares the stage times with those of a previous benchmark of the same configuration
+    :return: Stages slower than tolerance times the baseline
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if baseline['config'] != results['config']:
+        print(f'Configuration of {baseline_file} differs, times are not comparable')
+    regressions = []
+    print(f'Compared with {baseline_file} ({baseline.get("commit")}):')
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        ratio = result['seconds'] / baseline['stages'][stage]['seconds']
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(stage)
+            flag = '  <-- regression'
+        print(f'{stage:<34}{baseline["stages"][stage]["seconds"]:>10.3f} -> {result["seconds"]:>10.3f} seconds '
+              f'({ratio:.2f}x){flag}')
+    return regressions
+
+
+def run_benchmark(work_dir, year=2020, days=30, n_stations=1000, var_names=('ppt', 'tmin', 'tmax'), workers=4,
+                  file_format='csv', batch_size=200, nrows=NROWS, ncols=NCOLS, stages=STAGES, verbose=False):
+    """
+    Times the pipeline end to end on synthetic data: download_prism_bill from a local HTTP server, extraction of the
+    stations, concatenation of the series and the station-wise csv and .dly files (convert2dly)
+    :param work_dir: Directory of the synthetic archives (kept between runs) and of the pipeline outputs (replaced)
+    :param days: Number of days generated from January 1; the later dates of the year answer 404 like unreleased
+                dates
+    :param n_stations: Number of synthetic stations
+    :param var_names: Variables generated; ppt, tmin and tmax are required by the .dly files
+    :param workers: Download threads and processes of extraction and conversion
+    :param stages: Stages timed, in pipeline order; each needs the outputs of the previous ones. startup times the
+                start of the command line tools, see time_startup
+    :return: Dictionary of the configuration, environment and stage results, saved as JSON by main
+    """
+    var_names = list(var_names)
+    results = {}
+    if 'startup' in stages:
+        results.update(time_startup())
+    config = {'year': year, 'days': days, 'stations': n_stations, 'variables': var_names, 'workers': workers,
+              'file_format': file_format, 'batch_size': batch_size, 'grid': [nrows, ncols]}
+    summary = {'config': config, 'started': datetime.now().isoformat(timespec='seconds'), 'commit': get_git_commit(),
+               'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+               'platform': platform.platform(), 'cpus': os.cpu_count(), 'stages': results}
+    if not any(stage in stages for stage in STAGES[1:]):
+        return summary
+    server_dir = create_save_folder(work_dir, f'Server_{nrows}x{ncols}')
+    print(f'Generating synthetic archives under {server_dir}')
+    n_archives, archive_bytes = make_synthetic_grids(server_dir, var_names, year, days, nrows, ncols)
+    run_dir = os.path.join(work_dir, 'Run')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    import_dir = create_save_folder(run_dir, 'Import')
+    station_file = make_synthetic_stations(os.path.join(run_dir, 'stations.csv'), n_stations, nrows, ncols)
+    # Imported here so the startup cost of the pipeline modules is not part of the first stage
+    from downloadPrismBill import download_prism_bill
+    from extract_daily_var import extract_daily_vars
+    from concatenate_data import concatenate_data
+    from convert_weather import convert_weather
+
+    if 'download' in stages:
+        server, url_web = start_server(server_dir)
+        try:
+            for var_name in var_names:
+                run_stage(f'download_{var_name}', results, verbose, download_prism_bill, 'daily', var_name, year,
+                          os.path.join(run_dir, 'Prism'), workers=workers, url_web=url_web)
+        finally:
+            server.shutdown()
+        combine_stages(results, 'download', [f'download_{var_name}' for var_name in var_names])
+        add_throughput(results['download'], files=n_archives, n_bytes=archive_bytes)
+    else:
+        # archives are copied and extracted in place of the download so the following stages can run
+        for var_name in var_names:
+            source_dir = os.path.join(server_dir, 'daily', var_name, str(year))
+            zip_dir = create_save_folder(run_dir, f'Prism/Zip_Folder/daily/{var_name}')
+            for zip_file in os.listdir(source_dir):
+                shutil.copy2(os.path.join(source_dir, zip_file), zip_dir)
+                ymd = zip_file.split('_')[4]
+                with zipfile.ZipFile(os.path.join(zip_dir, zip_file)) as zf:
+                    zf.extractall(os.path.join(run_dir, 'Prism/Variables/daily', var_name, ymd))
+    if 'extract' in stages:
+        # incremental extracts the downloaded days only, the rest of the year is not released
+        run_stage('extract', results, verbose, extract_daily_vars, run_dir, year, var_names,
+                  station_file=station_file, output_dir=import_dir, workers=workers, file_format=file_format,
+                  incremental=True)
+        metrics = results['extract']['metrics']
+        add_throughput(results['extract'], station_days=n_stations * days * len(var_names),
+                       files=metrics.get('open', {}).get('files', days * len(var_names)),
+                       n_bytes=metrics.get('read', {}).get('bytes', 0))
+    if 'concatenate' in stages:
+        input_bytes = sum(os.path.getsize(os.path.join(import_dir, f'Prism_{var_name}_{year}.{file_format}'))
+                          for var_name in var_names)
+        for var_name in var_names:
+            run_stage(f'concatenate_{var_name}', results, verbose, concatenate_data, year, year + 1, None,
+                      import_dir, var_name, file_format=file_format)
+        combine_stages(results, 'concatenate', [f'concatenate_{var_name}' for var_name in var_names])
+        add_throughput(results['concatenate'], station_days=n_stations * days * len(var_names),
+                       files=len(var_names), n_bytes=input_bytes)
+    if 'convert' in stages:
+        weather_dir = os.path.join(import_dir, 'Weather_Data')
+        run_stage('convert', results, verbose, convert_weather, weather_dir, year, year + 1, var_names,
+                  file_ext=file_format, workers=workers, batch_size=batch_size)
+        metrics = results['convert']['metrics']
+        add_throughput(results['convert'], station_days=n_stations * days,
+                       files=sum(metrics.get(stage, {}).get('files', 0) for stage in ['write', 'write_dly']),
+                       n_bytes=sum(metrics.get(stage, {}).get('bytes', 0) for stage in ['write', 'write_dly']))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of download, extraction, concatenation and .dly conversion on synthetic PRISM grids."
+    )
+    parser.add_argument('--work_dir', type=str, default='Benchmark',
+                        help='Directory of the synthetic data, pipeline outputs and results. Default Benchmark')
+    parser.add_argument('--year', type=int, default=2020, help='Year of the synthetic grids. Default 2020')
+    parser.add_argument('--days', type=int, default=30, help='Number of days generated from January 1. Default 30')
+    parser.add_argument('--stations', type=int, default=1000, help='Number of synthetic stations. Default 1000')
+    parser.add_argument('--attributes', type=str, nargs='+', default=['ppt', 'tmin', 'tmax'],
+                        help='Variables generated; ppt, tmin and tmax are required by the .dly files')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Download threads and processes of extraction and conversion. Default 4')
+    parser.add_argument('--file_format', type=str, default='csv', help='csv (default) or parquet')
+    parser.add_argument('--batch_size', type=int, default=200, help='Stations per batch of the conversion')
+    parser.add_argument('--grid', type=int, nargs=2, default=[NROWS, NCOLS],
+                        help=f'Rows and columns of the grids. Default {NROWS} {NCOLS} (PRISM 4 km)')
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES,
+                        help='Stages timed: startup download extract concatenate convert (default all)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file of the results. Default <work_dir>/Results/benchmark_<time>.json')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results of a previous benchmark; exits with status 1 when a stage is slower')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='Slowdown relative to the baseline reported as a regression. Default 1.2')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the pipeline stages')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.work_dir, year=args.year, days=args.days, n_stations=args.stations,
+                            var_names=args.attributes, workers=args.workers, file_format=args.file_format,
+                            batch_size=args.batch_size, nrows=args.grid[0], ncols=args.grid[1], stages=args.stages,
+                            verbose=args.verbose)
+    print('-------------------------------------------------------------------------------')
+    for stage, result in results['stages'].items():
+        rates = ', '.join(f'{result[key]} {label}' for key, label in [('station_days_per_second', 'station-days/s'),
+                                                                       ('files_per_second', 'files/s'),
+                                                                       ('mb_per_second', 'MB/s')] if key in result)
+        if 'modules' in result:
+            rates = f'imports {result["modules"]}'
+        if 'peak_memory_mb' in result:
+            rates = f'{rates}  peak {result["peak_memory_mb"]} MB'
+        print(f'{stage:<34}{result["seconds"]:>10.3f} seconds  {rates}')
+    output = args.output
+    if output is None:
+        results_dir = create_save_folder(args.work_dir, 'Results')
+        output = os.path.join(results_dir, f'benchmark_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results are saved in {output}')
+    if args.baseline is not None and compare_results(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
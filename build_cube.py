@@ -0,0 +1,98 @@
+"""
+    Program: Pack daily PRISM grids of a year into a single chunked, compressed raster cube
+    Author: Mahesh Lal Maskey, Ph.D. in Hydrologic Sciences
+    Affiliations: USDA-ARS, Sustainable Water Management Research Unit, Stoneville/Leland MS
+                  University of California, Davis, Department of Land, Air, and Water Resources
+    E-mail: mahesh.maskey@usda.gov/mmaskey@ucdavis.edu
+"""
+# Syntax: python build_cube.py --root_dir='path/to/downloaded_PRISM_data' --start_year=1981 --end_year=2023
+# --attribute=ppt --scale=daily
+
+import argparse
+import os
+import numpy as np
+import rasterio
+from datetime import datetime
+from rasterio.windows import Window
+from Utility import get_cube_path
+from Utility import get_date_vec
+from Utility import grid_fingerprint
+from Utility import print_progress_bar
+from Utility import read_bil_file
+
+
+def build_cube(root_dir, year, var_name, scale='daily', block_size=128):
+    """
+    Writes all days of a year as the bands of one tiled, deflate-compressed, pixel-interleaved GeoTIFF so that the
+    time series of a pixel lives in a single tile. extract_daily_var reads the cube instead of the daily files
+    when it exists.
+    :param root_dir: Directory where the Prism data were downloaded
+    :param year: Year to pack
+    :param var_name: PRISM variable, e.g., ppt
+    :param scale: daily or monthly
+    :param block_size: Tile size in pixels; each strip of this many rows is read from every day before writing
+    :return: Path of the cube
+    """
+    num_dates, date_vec = get_date_vec(year, scale)
+    n_days = len(num_dates)
+    cube_file = get_cube_path(root_dir, var_name, year, scale)
+    os.makedirs(os.path.dirname(cube_file), exist_ok=True)
+    raster = read_bil_file(main_path=root_dir, var_name=var_name, year=str(year), ymd=num_dates[0], scale=scale)
+    fingerprint = grid_fingerprint(raster)
+    profile = raster.profile
+    height, width = raster.height, raster.width
+    nodata = -9999 if raster.nodata is None else raster.nodata
+    raster.close()
+    profile.update(driver='GTiff', count=n_days, dtype='float32', nodata=nodata, tiled=True,
+                   blockxsize=block_size, blockysize=block_size, compress='deflate', predictor=3,
+                   interleave='pixel', bigtiff='IF_SAFER')
+    t0 = datetime.now()
+    print(f'Packing {n_days} {var_name} grids of {year} into {cube_file}')
+    n_strips = int(np.ceil(height / block_size))
+    print_progress_bar(0, n_strips, prefix='', suffix='', decimals=1, length=50, fill='█')
+    with rasterio.open(f'{cube_file}.part', 'w', **profile) as dst:
+        for k in range(n_days):
+            dst.set_band_description(k + 1, str(date_vec[k]))
+        for s in range(n_strips):
+            window = Window(0, s * block_size, width, min(block_size, height - s * block_size))
+            strip = np.full((n_days, window.height, width), nodata, dtype='float32')
+            for k in range(n_days):
+                try:
+                    raster = read_bil_file(main_path=root_dir, var_name=var_name, year=str(year),
+                                           ymd=num_dates[k], scale=scale)
+                except FileNotFoundError:
+                    if s == 0:
+                        print(f'\n{num_dates[k]} is not available and is filled with {nodata}')
+                    continue
+                if grid_fingerprint(raster) != fingerprint:
+                    raise ValueError(f'Grid of {num_dates[k]} differs from {num_dates[0]}, cannot pack into one cube')
+                strip[k] = raster.read(1, window=window)
+                raster.close()
+            dst.write(strip, window=window)
+            print_progress_bar(s + 1, n_strips, prefix=f'{s + 1}/{n_strips}',
+                               suffix=f'{round((datetime.now() - t0).total_seconds(), 3)} seconds',
+                               decimals=1, length=50, fill='█')
+    os.replace(f'{cube_file}.part', cube_file)
+    print(f'Cube of {var_name} for {year} is saved in {cube_file}')
+    print('-------------------------------------------------------------------------------')
+    return cube_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pack daily PRISM grids of each year into a single raster cube."
+    )
+    parser.add_argument('--root_dir', type=str, required=True, help='Download folder')
+    parser.add_argument('--start_year', type=int, required=True, help='Beginning of year to process')
+    parser.add_argument('--end_year', type=int, required=True, help='End of year to process')
+    parser.add_argument('--attribute', type=str, required=True,
+                        help='One PRISM attribute: ppt tmin tdmean tmax vpdmin vpdmax')
+    parser.add_argument('--scale', type=str, default='daily', help='Time scale: daily or monthly')
+    args = parser.parse_args()
+
+    for year in range(args.start_year, args.end_year + 1):
+        build_cube(args.root_dir, year, args.attribute, scale=args.scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,90 @@
 import os
+import csv
+from datetime import datetime
 import numpy as np
 import argparse
 import pandas as pd
 from Utility import read_import_data
+from Utility import get_import_file
+from Utility import get_import_dates
+from Utility import get_weather_dates
+from Utility import get_weather_stations
 from Utility import create_save_folder
 from Utility import print_progress_bar
+from Utility import report_metrics
+from Utility import timed_stage
 
 # python concatenate_data.py --start-year 1981 --end-year 2023 --attribute ppt --state-name Mississippi --data-dir Spatial_data/Shapefile
-def concatenate_data(start_year, end_year, state_name, data_dir, attribute):
+def read_output_stations(file_path):
+    """
+    Station id columns of an existing concatenated series as written
+    """
+    if file_path.endswith('.parquet'):
+        return [str(c) for c in get_weather_stations(file_path)]
+    with open(file_path, newline='') as f:
+        return next(csv.reader(f))[1:]
+
+
+def truncate_output(file_path, first_date):
+    """
+    Cuts a concatenated csv series before its first row dated first_date or later, keeping the header
+    :return: Dates of the rows kept
+    """
+    kept_dates = []
+    with open(file_path, 'rb+') as f:
+        offset = len(f.readline())
+        for line in iter(f.readline, b''):
+            date = line.split(b',', 1)[0].decode()
+            if date >= first_date:
+                break
+            kept_dates.append(date)
+            offset += len(line)
+        f.truncate(offset)
+    return kept_dates
+
+
+def copy_output_rows(parquet_writer, file_path, schema, first_date=None):
+    """
+    Streams an existing parquet series into parquet_writer one record batch at a time, so memory stays bounded by a
+    batch rather than the whole series
+    :param first_date: Rows dated first_date or later are dropped
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file_path)
+    date_column = parquet_file.schema_arrow.pandas_metadata['index_columns'][0]
+    for batch in parquet_file.iter_batches():
+        if first_date is not None:
+            dates = pd.to_datetime(batch.column(date_column).to_pandas())
+            batch = batch.filter(pa.array(dates < pd.Timestamp(first_date)))
+        if batch.num_rows > 0:
+            parquet_writer.write_table(pa.Table.from_batches([batch]).cast(schema))
+
+
+def concatenate_data(start_year, end_year, state_name, data_dir, attribute, file_format='csv', incremental=False):
+    """
+    Streams the yearly extracts into one dates x stations series. Years are aligned on the station id and appended
+    to the output one at a time, so memory stays bounded by one year.
+    With incremental, days already in an existing output are not read again and only the new days are appended,
+    provided the stations did not change; otherwise the series is rebuilt. Years extracted again after the output
+    was written, e.g., with provisional days upgraded to stable, are rewritten with all the years after them.
+    """
     year_vec = np.arange(start_year, end_year)
+    info_cols = ['stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)']
 
-    df = pd.DataFrame()
-    m = 0
-    print_progress_bar(m, len(year_vec), prefix='', suffix='', decimals=1, length=50, fill='█')
+    # First pass reads only the station information to fix the columns of the output
+    df_list = None
     for year in year_vec:
-        df_ppt = read_import_data(data_dir, state_name, attribute, year)
-        df = pd.concat([df, df_ppt], axis=1)
-        print_progress_bar(m + 1, len(year_vec), prefix=f'{m}', suffix=f'{year}', decimals=1, length=50,
-                           fill='█')
-        m = m + 1
-    print('\nCompleted concatenating')
-    df = df.loc[:, ~df.columns.duplicated()].copy()
-    df_list = df.iloc[:, 1:6]
-    df_list.index = df.Station
+        df_info = read_import_data(data_dir, state_name, attribute, year, usecols=['Station'] + info_cols)
+        df_info = df_info.set_index('Station')
+        if df_list is None:
+            df_list = df_info
+        else:
+            df_list = pd.concat([df_list, df_info[~df_info.index.isin(df_list.index)]], axis=0)
+    # Series columns are the unique station ids; names are kept in the station information file
+    station_ids = df_list.index
+    station_columns = [str(s) for s in station_ids]
     df_list = df_list.drop('stnid', axis=1)
-    df_attribute = df.iloc[:, 6:]
-    df_attribute.index = df_list.Name
-    df_attribute = df_attribute.T
 
     # out_dir = create_save_folder(root_dir=os.getcwd(), sub_dir='Weather_Data')
     if state_name==None:
@@ -38,9 +96,82 @@ def concatenate_data(start_year, end_year, state_name, data_dir, attribute):
     out_file_path = os.path.join(out_dir, out_file)
     df_list.to_csv(out_file_path)
     
-    out_file = f'PRISM_{start_year}_{end_year}_daily_{attribute}.csv'
+    out_file = f'PRISM_{start_year}_{end_year}_daily_{attribute}'
     out_file_path = os.path.join(out_dir, out_file)
-    df_attribute.to_csv(out_file_path)
+
+    # Days already concatenated, skipped when the output is updated in place
+    done_dates = set()
+    if incremental and os.path.isfile(f'{out_file_path}.{file_format}'):
+        if read_output_stations(f'{out_file_path}.{file_format}') == station_columns:
+            done_dates = set(get_weather_dates(f'{out_file_path}.{file_format}'))
+        else:
+            print(f'Stations of {out_file_path}.{file_format} changed, the series is rebuilt')
+    # Days of a year re-extracted since the output was written may have changed, so the output is cut before the
+    # first such year and rewritten from there
+    rewrite_year = None
+    if len(done_dates) > 0:
+        output_mtime = os.path.getmtime(f'{out_file_path}.{file_format}')
+        for year in year_vec:
+            if any(d.startswith(f'{year}-') for d in done_dates) and \
+                    os.path.getmtime(get_import_file(data_dir, state_name, attribute, year)) > output_mtime:
+                rewrite_year = year
+                print(f'{attribute} for {year} was extracted again after {out_file_path}.{file_format} was written, '
+                      f'the series is rewritten from {year}')
+                break
+    first_date = None if rewrite_year is None else f'{rewrite_year}-01-01'
+    if first_date is not None and file_format == 'csv':
+        done_dates = set(truncate_output(f'{out_file_path}.csv', first_date))
+    elif first_date is not None:
+        done_dates = {d for d in done_dates if d < first_date}
+    append = len(done_dates) > 0
+
+    # Second pass appends the days of each year to the output
+    parquet_writer = None
+    m = 0
+    print_progress_bar(m, len(year_vec), prefix='', suffix='', decimals=1, length=50, fill='█')
+    for year in year_vec:
+        if append and (rewrite_year is None or year < rewrite_year):
+            new_dates = [d for d in get_import_dates(data_dir, state_name, attribute, year) if d not in done_dates]
+            if len(new_dates) == 0:
+                m = m + 1
+                continue
+            with timed_stage('read', n_files=1):
+                df_year = read_import_data(data_dir, state_name, attribute, year, usecols=['Station'] + new_dates)
+            with timed_stage('assemble'):
+                df_attribute = df_year.set_index('Station').reindex(station_ids).T
+        else:
+            with timed_stage('read', n_files=1):
+                df_year = read_import_data(data_dir, state_name, attribute, year).set_index('Station')
+            with timed_stage('assemble'):
+                df_attribute = df_year.drop(columns=info_cols).reindex(station_ids).T
+        df_attribute.columns = station_columns
+        with timed_stage('write', n_bytes=df_attribute.memory_usage(index=False).sum()):
+            if file_format == 'parquet':
+                # typed values and dates as a proper index so downstream stages do not re-parse text
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                df_attribute = df_attribute.astype('float32')
+                df_attribute.index = pd.to_datetime(df_attribute.index)
+                df_attribute.index.name = 'Date'
+                table = pa.Table.from_pandas(df_attribute)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(f'{out_file_path}.parquet.part', table.schema)
+                    if append:
+                        # parquet files cannot be appended to, the existing days are copied into the new file first
+                        copy_output_rows(parquet_writer, f'{out_file_path}.parquet', table.schema, first_date)
+                parquet_writer.write_table(table)
+            elif file_format == 'csv':
+                first = m == 0 and not append
+                df_attribute.to_csv(f'{out_file_path}.csv', mode='w' if first else 'a', header=first)
+            else:
+                raise ValueError(f'Unsupported file format {file_format}')
+        print_progress_bar(m + 1, len(year_vec), prefix=f'{m}', suffix=f'{year}', decimals=1, length=50,
+                           fill='█')
+        m = m + 1
+    if parquet_writer is not None:
+        parquet_writer.close()
+        os.replace(f'{out_file_path}.parquet.part', f'{out_file_path}.parquet')
+    print('\nCompleted concatenating')
     print(f'\nCompleted importing {attribute} Prism data')
     print('\n------------------------------------------------------------')
 
@@ -59,8 +190,18 @@ def main():
     parser.add_argument("--attribute", type=str, required=True, 
         help="One PRISM attributes: ppt tmin tdmean tmax vpdmin vpdmax"
         )
+    parser.add_argument("--file-format", type=str, default="csv",
+        help="File format of the concatenated series: csv (default) or parquet"
+        )
+    parser.add_argument("--incremental", action="store_true",
+        help="Append only the days missing from an existing concatenated series"
+        )
+    parser.add_argument("--metrics-file", type=str, default=None,
+        help="JSON file where the seconds, calls, bytes and files of each stage of the run are saved"
+        )
 
     args = parser.parse_args()
+    t0 = datetime.now()
     # Convert string NONE/None/null to Python None
     if args.state_name is not None:
         if args.state_name.lower() in ["none", "null"]:
@@ -71,8 +212,11 @@ def main():
         end_year=args.end_year,
         state_name=args.state_name,
         data_dir=args.data_dir,
-        attribute=args.attribute
+        attribute=args.attribute,
+        file_format=args.file_format,
+        incremental=args.incremental
     )
+    report_metrics(t0, metrics_file=args.metrics_file, script='concatenate_data', args=vars(args))
 
 
 if __name__ == "__main__":
@@ -1,50 +1,192 @@
 import os
-
-import re
+import argparse
+import tempfile
+from concurrent.futures import as_completed
+from contextlib import contextmanager
 import pandas as pd
 from Utility import create_save_folder
 from Utility import convert2dly
+from Utility import csv_to_parquet
+from Utility import get_station_file_name
+from Utility import get_weather_stations
+from Utility import merge_metrics
+from Utility import pop_metrics
 from Utility import print_progress_bar
+from Utility import read_weather_data
+from Utility import report_metrics
+from Utility import timed_stage
+from Utility import worker_pool
 from datetime import datetime
 
-# Read weather file imported
-df_ppt = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_ppt.csv', index_col=0)
-df_ppt.index = pd.to_datetime(df_ppt.index)
-df_tmin = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_tmin.csv', index_col=0)
-df_tmin.index = pd.to_datetime(df_tmin.index)
-df_tdmean = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_tdmean.csv', index_col=0)
-df_tdmean.index = pd.to_datetime(df_tdmean.index)
-df_tmax = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_tmax.csv', index_col=0)
-df_tmax.index = pd.to_datetime(df_tmax.index)
-df_vpdmin = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_vpdmin.csv', index_col=0)
-df_vpdmin.index = pd.to_datetime(df_vpdmin.index)
-df_vpdmax = pd.read_csv('Weather_Data/Mississippi/PRISM_1981_2023_daily_vpdmax.csv', index_col=0)
-df_vpdmax.index = pd.to_datetime(df_vpdmax.index)
-out_dir = create_save_folder('Weather_Data/Mississippi', 'Station')
-stn_list = df_ppt.columns
-t0 = datetime.now()
-n_stn = len(stn_list)
-m = 0
-print_progress_bar(m, n_stn, prefix='', suffix='', decimals=1, length=50, fill='█')
-# Build station wise longer form data
-for stn in stn_list:
-    file = ''.join(re.findall(r'[a-zA-Z]+', stn))
-    # if '/' in stn:
-    #     file = stn.split('/')
-    #     file = file[0] + file[1]
-    # else:
-    #     file = stn
-    df = pd.DataFrame({'ppt': df_ppt[stn].values, 'tmin': df_tmin[stn].values, 'tdmean': df_tdmean[stn].values,
-                       'tmax': df_tmax[stn].values, 'vpdmin': df_vpdmin[stn].values, 'vpdmax': df_vpdmax[stn].values},
-                      index=df_ppt.index)
+# python convert_weather.py --state-name Mississippi --start-year 1981 --end-year 2023 --variables ppt tmin tdmean
+# tmax vpdmin vpdmax --batch-size 200 --workers 4
+
+
+def write_station_files(dates, stn, values, out_dir, variables):
+    """
+    Writes the csv and .dly weather files of one station
+    :param dates: DatetimeIndex of the series
+    :param stn: Station id, column of the concatenated series
+    :param values: Sequence of daily series in the order of `variables`
+    :param out_dir: Directory where the files are saved
+    :param variables: Names of the weather variables
+    """
+    file = get_station_file_name(stn)
+    df = pd.DataFrame(dict(zip(variables, values)), index=dates)
     df.insert(0, 'Year', df.index.year)
     df.insert(1, 'Month', df.index.month)
     df.insert(2, 'Day', df.index.day)
-    df.to_csv(os.path.join(out_dir, f'{file}.csv'))
+    with timed_stage('write', n_files=1) as counts:
+        df.to_csv(os.path.join(out_dir, f'{file}.csv'))
+        counts['bytes'] = os.path.getsize(os.path.join(out_dir, f'{file}.csv'))
     # convert weather file into fortran format
     ff_file = os.path.join(out_dir, f'{file}.dly')
-    convert2dly(df, ff_file)
-    m = m + 1
-    print_progress_bar(m, n_stn, prefix=f'{m}/{n_stn}',
-                       suffix=f'{stn} in {round((datetime.now() - t0).total_seconds(), 3)} seconds ', decimals=1,
-                       length=50, fill='█')
+    with timed_stage('write_dly', n_files=1) as counts:
+        convert2dly(df, ff_file)
+        counts['bytes'] = os.path.getsize(ff_file)
+
+
+def convert_station_batch(files, stations, out_dir):
+    """
+    Loads only the columns of a batch of stations from every variable file and writes their weather files.
+    Run by the worker processes of convert_weather.
+    :param files: Dictionary of variable name to concatenated series file
+    :param stations: Station columns of the batch
+    :return: Number of stations written and the metrics of the batch, merged into the run metrics by the caller
+    """
+    with timed_stage('read', n_files=len(files)):
+        df_list = [read_weather_data(file_path, stations=stations) for file_path in files.values()]
+    # parquet series carry a named Date index, csv ones do not; station files are written the same from both
+    dates = df_list[0].index.rename(None)
+    for stn in stations:
+        write_station_files(dates, stn, [df[stn].values for df in df_list], out_dir, list(files))
+    return len(stations), pop_metrics()
+
+
+@contextmanager
+def columnar_files(files, weather_dir, n_batches):
+    """
+    A csv series is tokenized whole even when only the columns of a batch are used, so with several batches every
+    file would be parsed once per batch. The csv series are converted once into temporary parquet files, which the
+    batches read by column and which are removed at the end. Parquet input, a single batch or a missing pyarrow
+    yield the files unchanged.
+    :param files: Dictionary of variable name to concatenated series file
+    :return: Dictionary of variable name to the file the batches read
+    """
+    if n_batches <= 1 or not all(file_path.endswith('.csv') for file_path in files.values()):
+        yield files
+        return
+    try:
+        import pyarrow
+    except ImportError:
+        print('pyarrow is not installed, so every batch parses the csv series again; for large states concatenate '
+              'the series with --file-format parquet or raise --batch-size')
+        yield files
+        return
+    with tempfile.TemporaryDirectory(prefix='columns_', dir=weather_dir) as column_dir:
+        parquet_files = {}
+        for var_name, file_path in files.items():
+            parquet_files[var_name] = os.path.join(column_dir, f'{var_name}.parquet')
+            with timed_stage('columnar', n_bytes=os.path.getsize(file_path), n_files=1):
+                csv_to_parquet(file_path, parquet_files[var_name])
+        yield parquet_files
+
+
+def convert_weather(weather_dir, start_year, end_year, variables, file_ext='csv', workers=1, batch_size=200):
+    """
+    Builds station-wise weather files (csv and .dly) from the series concatenated by concatenate_data.py.
+    Stations are processed in batches and only the columns of a batch are loaded, so memory is proportional to
+    the batch rather than to the whole state and period.
+    :param weather_dir: Directory of the PRISM_<start_year>_<end_year>_daily_<variable> files
+    :param variables: Weather variables to include; ppt, tmin and tmax are required by the .dly format
+    :param file_ext: csv or parquet. Parquet loads the columns of a batch directly; csv is converted once to
+    temporary parquet files when there are several batches, see columnar_files
+    :param workers: Number of processes the batches are spread over. 1 runs serially in the current process
+    :param batch_size: Number of stations loaded at once
+    """
+    missing = [var for var in ['ppt', 'tmin', 'tmax'] if var not in variables]
+    if len(missing) > 0:
+        raise ValueError(f'Variables {missing} are required to write .dly files')
+    files = {var: os.path.join(weather_dir, f'PRISM_{start_year}_{end_year}_daily_{var}.{file_ext}')
+             for var in variables}
+    stn_list = list(get_weather_stations(files[variables[0]]))
+    batches = [stn_list[i:i + batch_size] for i in range(0, len(stn_list), batch_size)]
+    out_dir = create_save_folder(weather_dir, 'Station')
+    with columnar_files(files, weather_dir, len(batches)) as files:
+        t0 = datetime.now()
+        n_stn = len(stn_list)
+        m = 0
+        print_progress_bar(m, max(n_stn, 1), prefix='', suffix='', decimals=1, length=50, fill='█')
+        # Build station wise longer form data
+        if workers <= 1:
+            for batch in batches:
+                n, batch_metrics = convert_station_batch(files, batch, out_dir)
+                merge_metrics(batch_metrics)
+                m = m + n
+                print_progress_bar(m, n_stn, prefix=f'{m}/{n_stn}',
+                                   suffix=f'{batch[-1]} in {round((datetime.now() - t0).total_seconds(), 3)} seconds ',
+                                   decimals=1, length=50, fill='█')
+            return
+        with worker_pool(workers) as executor:
+            futures = [executor.submit(convert_station_batch, files, batch, out_dir) for batch in batches]
+            for future in as_completed(futures):
+                n, batch_metrics = future.result()
+                merge_metrics(batch_metrics)
+                m = m + n
+                print_progress_bar(m, n_stn, prefix=f'{m}/{n_stn}',
+                                   suffix=f'in {round((datetime.now() - t0).total_seconds(), 3)} seconds ',
+                                   decimals=1, length=50, fill='█')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build station-wise csv and .dly weather files from concatenated PRISM series."
+    )
+    parser.add_argument("--state-name", type=str, default=None,
+        help="State of the concatenated series, read from Weather_Data/<state-name> unless --weather-dir is given"
+        )
+    parser.add_argument("--weather-dir", type=str, default=None,
+        help="Directory of the concatenated series written by concatenate_data.py"
+        )
+    parser.add_argument("--start-year", type=int, default=1981)
+    parser.add_argument("--end-year", type=int, default=2023)
+    parser.add_argument("--variables", type=str, nargs='+', default=['ppt', 'tmin', 'tdmean', 'tmax', 'vpdmin',
+                                                                     'vpdmax'],
+        help="PRISM attributes to include: ppt tmin tdmean tmax vpdmin vpdmax"
+        )
+    parser.add_argument("--file-format", type=str, default='csv',
+        help="Format of the concatenated series: csv (default) or parquet"
+        )
+    parser.add_argument("--batch-size", type=int, default=200,
+        help="Number of stations loaded at once. Default 200"
+        )
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes the station batches are spread over. Default 1 (serial)"
+        )
+    parser.add_argument("--metrics-file", type=str, default=None,
+        help="JSON file where the seconds, calls, bytes and files of each stage of the run are saved"
+        )
+    args = parser.parse_args()
+    t0 = datetime.now()
+    # Convert string NONE/None/null to Python None
+    if args.state_name is not None:
+        if args.state_name.lower() in ["none", "null"]:
+            args.state_name = None
+    weather_dir = args.weather_dir
+    if weather_dir is None:
+        weather_dir = 'Weather_Data' if args.state_name is None else os.path.join('Weather_Data', args.state_name)
+
+    convert_weather(
+        weather_dir=weather_dir,
+        start_year=args.start_year,
+        end_year=args.end_year,
+        variables=args.variables,
+        file_ext=args.file_format,
+        workers=args.workers,
+        batch_size=args.batch_size
+    )
+    report_metrics(t0, metrics_file=args.metrics_file, script='convert_weather', args=vars(args))
+
+
+if __name__ == "__main__":
+    main()
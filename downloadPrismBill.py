@@ -8,92 +8,423 @@
 """
 
 from datetime import datetime
+import base64
+import hashlib
+import json
 import os
 import shutil
+import threading
+import time
+import zipfile
+import http.client
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote, urljoin, urlsplit
 from Utility import create_save_folder
 from Utility import do_zip
 from Utility import get_date_vec
 from Utility import print_progress_bar
+from Utility import timed_stage
 
+PRISM_URL = 'https://ftp.prism.oregonstate.edu'
+# Release grades of the PRISM grids, from the final to the earliest estimate
+GRADES = ['stable', 'provisional', 'early']
 
-def download_prism_bill(scale, var_name, year, dir2save):
+# One persistent HTTP connection per host and per download thread, with the headers and request target it needs
+thread_data = threading.local()
+
+
+def get_proxy(scheme, netloc):
+    """
+    Proxy of scheme set by the http_proxy/https_proxy environment variables, as urllib.request.urlopen uses them
+    :return: Proxy host:port, None when unset or netloc is listed in no_proxy, and headers authenticating with it
+    """
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None, {}
+    parts = urlsplit(proxy if '://' in proxy else f'http://{proxy}')
+    headers = {}
+    if parts.username is not None:
+        credentials = f'{unquote(parts.username)}:{unquote(parts.password or "")}'
+        headers['Proxy-Authorization'] = f'Basic {base64.b64encode(credentials.encode()).decode()}'
+    return parts.netloc.rpartition('@')[2], headers
+
+
+def get_connection(scheme, netloc, timeout=60):
+    """
+    Persistent connection of the calling thread to netloc, or to the proxy of scheme when one is set
+    :return: Connection, headers to send with each request and whether requests give the absolute url
+    """
+    connections = getattr(thread_data, 'connections', None)
+    if connections is None:
+        connections = thread_data.connections = {}
+    if (scheme, netloc) not in connections:
+        proxy, headers = get_proxy(scheme, netloc)
+        if proxy is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connections[(scheme, netloc)] = connection_class(netloc, timeout=timeout), {}, False
+        elif scheme == 'https':
+            # TLS with the server inside a CONNECT tunnel through the proxy, kept open like a direct connection
+            connection = http.client.HTTPSConnection(proxy, timeout=timeout)
+            connection.set_tunnel(netloc, headers=headers)
+            connections[(scheme, netloc)] = connection, {}, False
+        else:
+            connections[(scheme, netloc)] = http.client.HTTPConnection(proxy, timeout=timeout), headers, True
+    return connections[(scheme, netloc)]
+
+
+def drop_connection(scheme, netloc):
+    connections = getattr(thread_data, 'connections', {})
+    connection = connections.pop((scheme, netloc), None)
+    if connection is not None:
+        connection[0].close()
+
+
+def fetch_url(url, output_filepath, max_redirects=5):
+    """
+    Downloads url into output_filepath over the persistent connection of the calling thread, through the proxy of
+    the http_proxy/https_proxy environment variables when set. The file is written to a .part file first and moved in
+    place only when complete.
+    :raises FileNotFoundError: When the server does not have the file (HTTP 404)
+    :raises OSError: On any other HTTP status or a truncated transfer
+    """
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    connection, headers, absolute = get_connection(parts.scheme, parts.netloc)
+    try:
+        connection.request('GET', f'{parts.scheme}://{parts.netloc}{path}' if absolute else path, headers=headers)
+        response = connection.getresponse()
+    except (OSError, http.client.HTTPException):
+        drop_connection(parts.scheme, parts.netloc)
+        raise
+    if response.status in (301, 302, 303, 307, 308) and max_redirects > 0:
+        response.read()
+        return fetch_url(urljoin(url, response.getheader('Location')), output_filepath, max_redirects - 1)
+    if response.status == 404:
+        response.read()
+        raise FileNotFoundError(f'{url} does not exist')
+    if response.status != 200:
+        response.read()
+        raise OSError(f'HTTP {response.status} {response.reason} for {url}')
+    expected_size = response.getheader('Content-Length')
+    part_filepath = f'{output_filepath}.part'
+    try:
+        with open(part_filepath, 'wb') as f:
+            shutil.copyfileobj(response, f)
+            size = f.tell()
+    except (OSError, http.client.HTTPException):
+        drop_connection(parts.scheme, parts.netloc)
+        raise
+    if expected_size is not None and size != int(expected_size):
+        drop_connection(parts.scheme, parts.netloc)
+        raise OSError(f'Truncated download of {url}: {size} of {expected_size} bytes')
+    os.replace(part_filepath, output_filepath)
+    return size
+
+
+def is_valid_zip(file_path):
+    if not os.path.isfile(file_path):
+        return False
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            return zf.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+def get_grade(file_name):
+    for grade in GRADES:
+        if f'_{grade}_' in file_name:
+            return grade
+    return None
+
+
+def get_checksum(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_manifest_path(dir2save_zip):
+    return os.path.join(dir2save_zip, 'manifest.jsonl')
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the download manifest, one JSON record per line appended by download_prism_bill. A line that cannot be
+    read, e.g., cut short when a job was killed while appending it, is skipped so its date is verified again
+    :return: Dictionary of the latest record of each date
+    """
+    records = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            for k, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    records[record['date']] = record
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f'Skipped line {k} of {manifest_path}: {e}')
+    return records
+
+
+def end_manifest_line(manifest_path):
+    """
+    Ends a last line cut short by a killed job, so the records appended next start on their own line
+    """
+    if os.path.isfile(manifest_path) and os.path.getsize(manifest_path) > 0:
+        with open(manifest_path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+
+def append_manifest(manifest_file, record):
+    manifest_file.write(json.dumps(record) + '\n')
+    # flushed per record so a killed job keeps what it has verified
+    manifest_file.flush()
+
+
+def is_verified(file_path, record=None, verify=True, checksum=False):
+    """
+    Tells whether an archive already downloaded is complete
+    :param record: Manifest record of the date; when it describes this file, the size recorded at download must match
+    :param verify: Archives missing from the manifest are tested as zip files, otherwise only their presence is checked
+    :param checksum: Archives in the manifest are also re-hashed and compared with the checksum recorded
+    """
+    if not os.path.isfile(file_path):
+        return False
+    if record is not None and record.get('file') == os.path.basename(file_path) and 'size' in record:
+        if os.path.getsize(file_path) != record['size']:
+            return False
+        return not checksum or get_checksum(file_path) == record['sha256']
+    return is_valid_zip(file_path) if verify else True
+
+
+def is_extracted(file_path, destination):
+    if not os.path.isdir(destination):
+        return False
+    with zipfile.ZipFile(file_path) as zf:
+        members = [name for name in zf.namelist() if not name.endswith('/')]
+    return all(os.path.isfile(os.path.join(destination, name)) for name in members)
+
+
+def download_extract(urls, dir2save_zip, dir2save_extract_, retries=3, backoff=1.0, extract=True, verify=True,
+                     record=None, checksum=False):
+    """
+    Downloads the first available url of `urls` and extracts it, skipping what is already present and valid.
+    When a url comes before the archive already present, e.g., a stable grid replacing a provisional one, the older
+    archive and its extracted files are replaced.
+    :param urls: Candidate urls of the same date tried in order, e.g., stable, provisional then early grades
+    :param retries: Attempts per url on network errors, waiting backoff * 2 ** attempt seconds in between
+    :param extract: If False, the zip is kept as is and read later by read_bil_file through /vsizip/
+    :param verify: If False, an archive already present but not in the manifest is trusted without re-reading it;
+                fetch_url only moves complete downloads in place
+    :param record: Manifest record of the date from a previous run, see is_verified
+    :param checksum: Re-hash archives in the manifest instead of trusting their size
+    :return: Manifest record of the archive (without date) and 'skipped', 'downloaded' or 'upgraded'
+    """
+    for url in urls:
+        output_file = url.split('/')[-1]
+        output_filepath = os.path.join(dir2save_zip, output_file)
+        with timed_stage('verify'):
+            verified = is_verified(output_filepath, record, verify=verify, checksum=checksum)
+        if verified:
+            status = 'skipped'
+            break
+        try:
+            for attempt in range(retries):
+                try:
+                    with timed_stage('download') as counts:
+                        fetch_url(url, output_filepath)
+                        counts['bytes'], counts['files'] = os.path.getsize(output_filepath), 1
+                    break
+                except FileNotFoundError:
+                    raise
+                except (OSError, http.client.HTTPException):
+                    if attempt == retries - 1:
+                        raise
+                    time.sleep(backoff * 2 ** attempt)
+        except FileNotFoundError:
+            if url == urls[-1]:
+                raise
+            continue
+        if not is_valid_zip(output_filepath):
+            raise OSError(f'{output_file} is not a valid zip file')
+        status = 'downloaded'
+        # archives of a lower grade are superseded, together with what was extracted from them
+        for old_url in urls[urls.index(url) + 1:]:
+            old_filepath = os.path.join(dir2save_zip, old_url.split('/')[-1])
+            if os.path.isfile(old_filepath):
+                os.remove(old_filepath)
+                status = 'upgraded'
+        if status == 'upgraded':
+            shutil.rmtree(dir2save_extract_, ignore_errors=True)
+        break
+    if status == 'skipped' and record is not None and record.get('file') == output_file and 'size' in record:
+        new_record = {key: value for key, value in record.items() if key != 'date'}
+    else:
+        new_record = {'url': url, 'file': output_file, 'grade': get_grade(output_file),
+                      'size': os.path.getsize(output_filepath), 'sha256': get_checksum(output_filepath),
+                      'timestamp': datetime.now().isoformat(timespec='seconds'), 'extracted': False}
+    if not extract:
+        return new_record, status
+    # archives extracted by a previous run are not listed again unless their folder is gone
+    if not (new_record['extracted'] and status == 'skipped' and os.path.isdir(dir2save_extract_)):
+        os.makedirs(dir2save_extract_, exist_ok=True)
+        if not is_extracted(output_filepath, dir2save_extract_):
+            do_zip(file_path=output_filepath, destination=dir2save_extract_)
+        new_record['extracted'] = True
+    return new_record, status
+
+
+def format_date_ranges(dates):
+    """
+    Collapses consecutive dates (YYYYMMDD, YYYYMM or YYYY) into ranges for printing, e.g., a whole missing year
+    as 20210101-20211231
+    """
+    def ordinal(date):
+        if not date.isdigit():
+            return None
+        if len(date) == 8:
+            return datetime.strptime(date, '%Y%m%d').toordinal()
+        if len(date) == 6:
+            return int(date[:4]) * 12 + int(date[4:])
+        if len(date) == 4:
+            return int(date)
+        return None
+
+    ranges = []
+    for date in sorted(dates):
+        # anything else is printed unchanged rather than merged
+        if (ranges and len(date) == len(ranges[-1][1]) and ordinal(date) is not None
+                and ordinal(date) == ordinal(ranges[-1][1]) + 1):
+            ranges[-1][1] = date
+        else:
+            ranges.append([date, date])
+    return ', '.join(start if start == end else f'{start}-{end}' for start, end in ranges)
+
+
+def check_downloads(scale, var_name, year, dir2save, checksum=True):
+    """
+    Checks the archives of a year against the manifest without any network access
+    :param checksum: Re-hash the archives, otherwise only their size is compared
+    :return: Dates without a verified archive, e.g., never downloaded, truncated or corrupted
+    """
+    dir2save_zip = os.path.join(dir2save, 'Zip_Folder', scale, var_name)
+    manifest = read_manifest(get_manifest_path(dir2save_zip))
+    if scale == 'monthly' and year < 1981:
+        dates = [str(year)]
+    else:
+        dates, _ = get_date_vec(year, scale)
+    gaps = []
+    for date in dates:
+        record = manifest.get(date)
+        if record is None or 'size' not in record or not is_verified(os.path.join(dir2save_zip, record['file']),
+                                                                     record, checksum=checksum):
+            gaps.append(date)
+    return gaps
+
+
+def download_prism_bill(scale, var_name, year, dir2save, workers=4, retries=3, url_web=PRISM_URL, extract=True,
+                        incremental=False, checksum=False):
+    """
+    Downloads and extracts PRISM grids of a year. Files already downloaded and valid are not fetched again,
+    so rerunning a partially finished year only fetches what is missing. Recent dates are fetched as provisional or
+    early grids when the stable one is not released yet; later runs check those dates for a higher grade and only
+    replace the ones that changed. The url, grade, size, checksum, time and extraction of each date are recorded in
+    Zip_Folder manifest.jsonl, and archives matching their record are skipped without being re-read.
+    :param workers: Number of files downloaded concurrently
+    :param retries: Attempts per file on network errors, with exponential backoff
+    :param url_web: Root of the PRISM repository, can point to a local mirror
+    :param extract: If False, archives are only downloaded; extraction reads the rasters straight from the zips
+    :param incremental: If True, dates after today are not requested and archives already present are not re-read,
+                so a nightly run only fetches the newly released dates
+    :param checksum: Re-hash archives in the manifest instead of trusting their size, e.g., after a storage failure
+    """
     dir2save_zip = create_save_folder(root_dir=dir2save, sub_dir='Zip_Folder')
     dir2save_zip = create_save_folder(root_dir=dir2save_zip, sub_dir=scale)
     dir2save_zip = create_save_folder(root_dir=dir2save_zip, sub_dir=var_name)
-    dir2save_extract = create_save_folder(root_dir=dir2save, sub_dir='Variables')
-    dir2save_extract = create_save_folder(root_dir=dir2save_extract, sub_dir=scale)
-    dir2save_extract = create_save_folder(root_dir=dir2save_extract, sub_dir=var_name)
+    if extract:
+        dir2save_extract = create_save_folder(root_dir=dir2save, sub_dir='Variables')
+        dir2save_extract = create_save_folder(root_dir=dir2save_extract, sub_dir=scale)
+        dir2save_extract = create_save_folder(root_dir=dir2save_extract, sub_dir=var_name)
+    else:
+        dir2save_extract = os.path.join(dir2save, 'Variables', scale, var_name)
     t0 = datetime.now()
     print(f'PRISM {var_name} data is downloading for {year}')
-    url_web = 'https://ftp.prism.oregonstate.edu'
+    # List of (date, candidate urls, extract folder) to download
+    tasks = []
     if scale == 'daily':
-        date_series = get_date_vec(year, scale)
-        n_days = len(date_series)
-        k = 0
-        print_progress_bar(k, n_days, prefix=f'{k}', suffix='', decimals=1, length=50, fill='█')
+        date_series, _ = get_date_vec(year, scale)
         for ymd in date_series:
-            try:
-                url = f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4kmD2_{ymd}_bil.zip '
-                req = urllib.request.Request(url)
-                output_file = url.split('/')[-1]
-                output_filepath = os.path.join(dir2save_zip, output_file)
-                with urllib.request.urlopen(req) as response, open(output_filepath, 'wb') as f:
-                    shutil.copyfileobj(response, f)
-                # print(f'{output_file} is downloaded and saved under {dir2save}')
-                # dir2save_extract = create_save_folder(root_dir=dir2save_extract, sub_dir=f'{year}')
-                dir2save_extract_ = create_save_folder(root_dir=dir2save_extract, sub_dir=ymd)
-                do_zip(file_path=output_filepath, destination=dir2save_extract_)
-            except Exception as e:
-                print(e)
-                print('Date does not exist')
-                break
-            print_progress_bar(k + 1, n_days, prefix=f'{k + 1}',
-                               suffix=f'{ymd} processed in {round((datetime.now() - t0).total_seconds(), 3)} seconds',
-                               decimals=1, length=50, fill='█')
-            k = k + 1
+            urls = [f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_{grade}_4kmD2_{ymd}_bil.zip'
+                    for grade in GRADES]
+            tasks.append((ymd, urls, os.path.join(dir2save_extract, ymd)))
     elif scale == 'monthly':
         if year < 1981:
-            try:
-                url = f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4kmM2_{year}_all_bil.zip'
-                req = urllib.request.Request(url)
-                output_file = url.split('/')[-1]
-                output_filepath = os.path.join(dir2save_zip, output_file)
-                with urllib.request.urlopen(req) as response, open(output_filepath, 'wb') as f:
-                    shutil.copyfileobj(response, f)
-                dir2save_extract_ = create_save_folder(root_dir=dir2save_extract, sub_dir=str(year))
-                do_zip(file_path=output_filepath, destination=dir2save_extract_)
-            except:
-                url = f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4kmM3_{year}_all_bil.zip'
-                req = urllib.request.Request(url)
-                output_file = url.split('/')[-1]
-                output_filepath = os.path.join(dir2save_zip, output_file)
-                with urllib.request.urlopen(req) as response, open(output_filepath, 'wb') as f:
-                    shutil.copyfileobj(response, f)
-                dir2save_extract_ = create_save_folder(root_dir=dir2save_extract, sub_dir=str(year))
-                do_zip(file_path=output_filepath, destination=dir2save_extract_)
+            urls = [f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4km{m}_{year}_all_bil.zip'
+                    for m in ('M2', 'M3')]
+            tasks.append((str(year), urls, os.path.join(dir2save_extract, str(year))))
         else:
             date_series, _ = get_date_vec(year, scale)
             for ym in date_series:
-                try:
-                    url = f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4kmM2_{ym}_bil.zip'
-                    req = urllib.request.Request(url)
-                    output_file = url.split('/')[-1]
-                    output_filepath = os.path.join(dir2save_zip, output_file)
-                    with urllib.request.urlopen(req) as response, open(output_filepath, 'wb') as f:
-                        shutil.copyfileobj(response, f)
-                    dir2save_extract_ = create_save_folder(root_dir=dir2save_extract, sub_dir=ym)
-                    do_zip(file_path=output_filepath, destination=dir2save_extract_)
-                except:
-                    url = f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_stable_4kmM3_{ym}_bil.zip'
-                    req = urllib.request.Request(url)
-                    output_file = url.split('/')[-1]
-                    output_filepath = os.path.join(dir2save_zip, output_file)
-                    with urllib.request.urlopen(req) as response, open(output_filepath, 'wb') as f:
-                        shutil.copyfileobj(response, f)
-                    dir2save_extract_ = create_save_folder(root_dir=dir2save_extract, sub_dir=ym)
-                    do_zip(file_path=output_filepath, destination=dir2save_extract_)
-                print(f'{output_file} is downloaded and saved under {dir2save}')
-    print(f'\nPRISM  {var_name} data for year {year}  is completed, saved under {dir2save_zip} and  '
-          f'unzipped under {dir2save_extract} in {round((datetime.now() - t0).total_seconds(), 3)} seconds\n')
+                urls = [f'{url_web}/{scale}/{var_name}/{year}/PRISM_{var_name}_{grade}_4km{m}_{ym}_bil.zip'
+                        for grade in GRADES for m in ('M2', 'M3')]
+                tasks.append((ym, urls, os.path.join(dir2save_extract, ym)))
+    if incremental:
+        today = datetime.now().strftime('%Y%m%d')
+        tasks = [task for task in tasks if task[0] <= today[:len(task[0])]]
+    manifest_path = get_manifest_path(dir2save_zip)
+    manifest = read_manifest(manifest_path)
+    end_manifest_line(manifest_path)
+    n_files = len(tasks)
+    # upgraded dates are grouped by (old grade, new grade)
+    k, n_skipped, missing, failed, upgraded = 0, 0, [], [], {}
+    print_progress_bar(k, max(n_files, 1), prefix=f'{k}', suffix='', decimals=1, length=50, fill='█')
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(manifest_path, 'a') as manifest_file:
+        futures = {executor.submit(download_extract, urls, dir2save_zip, extract_dir, retries, extract=extract,
+                                   verify=not incremental, record=manifest.get(date), checksum=checksum): date
+                   for date, urls, extract_dir in tasks}
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                record, status = future.result()
+                record = {'date': date, **record}
+                n_skipped += status == 'skipped'
+                if status == 'upgraded':
+                    upgraded.setdefault((manifest.get(date, {}).get('grade'), record['grade']), []).append(date)
+                if record != manifest.get(date):
+                    append_manifest(manifest_file, record)
+                    manifest[date] = record
+            except FileNotFoundError:
+                missing.append(date)
+            except Exception as e:
+                print(f'\n{date}: {e}')
+                failed.append(date)
+            k = k + 1
+            print_progress_bar(k, n_files, prefix=f'{k}',
+                               suffix=f'{date} processed in {round((datetime.now() - t0).total_seconds(), 3)} seconds',
+                               decimals=1, length=50, fill='█')
+    if n_skipped:
+        print(f'{n_skipped} files were already downloaded and skipped')
+    for (old_grade, new_grade), dates in upgraded.items():
+        print(f'Replaced {old_grade} with {new_grade} for {len(dates)} files: {format_date_ranges(dates)}')
+    grades = [manifest[date]['grade'] for date, _, _ in tasks if date in manifest]
+    if any(grade != 'stable' for grade in grades):
+        print(', '.join(f'{grades.count(grade)} {grade}' for grade in GRADES if grade in grades) + ' files')
+    if missing:
+        print(f'Date does not exist for {len(missing)} files: {format_date_ranges(missing)}')
+    if failed:
+        print(f'Failed after {retries} attempts for {len(failed)} files, rerun to resume: {format_date_ranges(failed)}')
+    if extract:
+        print(f'\nPRISM  {var_name} data for year {year}  is completed, saved under {dir2save_zip} and  '
+              f'unzipped under {dir2save_extract} in {round((datetime.now() - t0).total_seconds(), 3)} seconds\n')
+    else:
+        print(f'\nPRISM  {var_name} data for year {year}  is completed and saved under {dir2save_zip} '
+              f'in {round((datetime.now() - t0).total_seconds(), 3)} seconds\n')
     print('------------------------------------------------------------------------\n')
+    return missing, failed
@@ -7,19 +7,300 @@
     E-mail: mahesh.maskey@usda.gov/mmaskey@ucdavis.edu
 """
 
+import numpy as np
 import pandas as pd
 import os
-from pyproj import Transformer
 from datetime import datetime
+from functools import partial
 from Utility import get_station_list
+from Utility import get_polygon_list
 from Utility import read_bil_file
 from Utility import get_date_vec
 from Utility import print_progress_bar
-from Utility import get_lon_lat
+from Utility import get_station_index
+from Utility import get_station_pixels
+from Utility import sample_band
 from Utility import create_save_folder
+from Utility import write_table
+from Utility import get_cube_path
+from Utility import read_cube
+from Utility import read_cube_pixels
+from Utility import get_raster_mtime
+from Utility import merge_metrics
+from Utility import timed_stage
+from Utility import read_day_grids
+from Utility import worker_pool
 
 
-def extract_daily_var(root_dir, year, var_name, station_file=None, output_dir=None, scale='daily'):
+def sample_day(root_dir, year, scale, df_stations, station_index, sampling, var_names, ymd):
+    """
+    Reads the grids of one day and returns the values of all stations. Run by the worker processes of
+    extract_daily_vars
+    :param station_index: Station to pixel index; recomputed in memory when the grid of the day does not match it
+    :param sampling: nearest, bilinear or area, see get_station_pixels
+    :param var_names: Variables read for the day
+    :param ymd: Date formatted in PRISM repository
+    :return: List of 1D arrays of station values in the order of df_stations, one per variable, and the metrics of
+             the day, merged into the run metrics by the parent process
+    """
+    def index_grid(raster, fingerprint):
+        df_pixels = get_station_pixels(raster, df_stations, sampling)
+        df_pixels['fingerprint'] = fingerprint
+        return df_pixels
+
+    return read_day_grids(root_dir, year, scale, var_names, ymd, station_index, station_index.fingerprint.iloc[0],
+                          index_grid, sample_band, 'sample')
+
+
+def read_daily_var(output_file, output_format='wide', file_format='csv'):
+    """
+    Reads the yearly table written by write_daily_var
+    :param output_file: Path of the output without the format specific suffix
+    :return: Table indexed by station, the dates it holds as YYYY-MM-DD strings and its modification time,
+             or (None, [], None) when absent
+    """
+    if output_format == 'long':
+        output_file = f'{output_file}_long'
+    file_path = f'{output_file}.{file_format}'
+    if not os.path.isfile(file_path):
+        return None, [], None
+    if file_format == 'parquet':
+        df_day = pd.read_parquet(file_path)
+    else:
+        df_day = pd.read_csv(file_path, index_col=0)
+    if output_format == 'long':
+        dates = pd.unique(pd.to_datetime(df_day.Date).dt.strftime('%Y-%m-%d'))
+    else:
+        dates = [c for c in df_day.columns if c not in ['stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)']]
+    return df_day, list(dates), os.path.getmtime(file_path)
+
+
+def merge_daily_var(df_existing, df_day, output_format='wide'):
+    """
+    Adds the days of df_day to a yearly table read by read_daily_var, keeping stations in their existing order and
+    days in calendar order. Days present in both, e.g., re-extracted after a grade upgrade, take the new values
+    """
+    stations = df_existing.index.append(df_day.index[~df_day.index.isin(df_existing.index)]).unique()
+    if output_format == 'long':
+        # values read back from csv are float64, keep the dtype of the extraction so they are written as before
+        df_existing = df_existing.astype(df_day.dtypes.drop('Date').to_dict())
+        dates = pd.to_datetime(df_day.Date)
+        df_existing = df_existing[~pd.to_datetime(df_existing.Date).isin(dates)]
+        df_day = pd.concat([df_existing, df_day], axis=0)
+        order = np.lexsort((pd.to_datetime(df_day.Date).values, stations.get_indexer(df_day.index)))
+        return df_day.iloc[order]
+    info_cols = [c for c in df_existing.columns if c in ['stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)']]
+    updated_cols = [c for c in df_day.columns if c in df_existing.columns and c not in info_cols]
+    df_day = df_existing.drop(columns=updated_cols).combine_first(df_day)
+    date_cols = sorted(c for c in df_day.columns if c not in info_cols)
+    return df_day.reindex(index=stations, columns=info_cols + date_cols)
+
+
+def write_daily_var(df_info, values, dates, output_file, var_name, output_format='wide', file_format='csv',
+                    df_existing=None):
+    """
+    Materializes the yearly stations x days table once and writes it
+    :param df_info: Station information, one row per station
+    :param values: Array of shape (stations, days), or a list of them matching a list of variables in long layout
+    :param dates: Column label of each day
+    :param output_file: Path of the output without the format specific suffix
+    :param var_name: Variable, or list of variables written as columns of one long table
+    :param output_format: wide (one column per day, the default) or long (one row per station and day)
+    :param file_format: csv (default) or parquet, where values are stored as float32 and dates typed in long layout
+    :param df_existing: Optional. Table read by read_daily_var that the days are added to
+    :return: Path of the file written
+    """
+    var_names, value_list = ([var_name], [values]) if isinstance(var_name, str) else (list(var_name), list(values))
+    with timed_stage('assemble') as counts:
+        if file_format == 'parquet':
+            value_list = [values.astype('float32') for values in value_list]
+        if output_format == 'wide':
+            if len(var_names) > 1:
+                raise ValueError('Several variables can only be written in long layout')
+            df_values = pd.DataFrame(value_list[0], index=df_info.index, columns=[f'{d}' for d in dates])
+            df_day = pd.concat([df_info, df_values], axis=1)
+        elif output_format == 'long':
+            date_vec = np.asarray(dates, dtype=str)
+            if file_format == 'parquet':
+                date_vec = pd.to_datetime(date_vec)
+            columns = {'Date': np.tile(date_vec, len(df_info))}
+            columns.update({name: values.ravel() for name, values in zip(var_names, value_list)})
+            df_day = pd.DataFrame(columns, index=np.repeat(df_info.index.values, len(dates)))
+            df_day.index.name = df_info.index.name
+            output_file = f'{output_file}_long'
+        else:
+            raise ValueError(f'Unsupported output format {output_format}')
+        if df_existing is not None:
+            df_day = merge_daily_var(df_existing, df_day, output_format)
+        counts['bytes'] = sum(values.nbytes for values in value_list)
+    return write_table(df_day, output_file, file_format=file_format)
+
+
+def extract_daily_vars(root_dir, year, var_names, station_file=None, output_dir=None, scale='daily',
+                       station_index=None, workers=1, output_format='wide', file_format='csv', incremental=False,
+                       sampling='nearest', polygon_file=None, polygon_id=None):
+    """
+    Extracts several variables in a single pass: the station list and the station to pixel index are loaded once
+    and the grids of all variables are sampled day by day. Arguments are those of extract_daily_var.
+    :param var_names: List of variables, e.g., ['ppt', 'tmin', 'tmax']
+    :param output_format: wide or long give one output per variable; combined gives one long table Prism_<year>_long
+                with a column per variable
+    :return: Station to pixel index
+    """
+    if sampling == 'area':
+        # polygons take the place of the stations, their index and weights are saved next to polygon_file
+        csv_file, df_stations = get_polygon_list(main_path=root_dir, polygon_file=polygon_file, id_field=polygon_id)
+    else:
+        # Get list of station based on the hard coded year
+        csv_file, df_stations = get_station_list(main_path=root_dir, station_file=station_file,
+                                                 var_name=var_names[0])
+    # Define  dataframe with geographic information
+    df_day = df_stations[['stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)']]
+    # Get series of date formatted in PRISM repository
+    num_dates, date_vec = get_date_vec(year, scale)
+    n_stations = len(df_stations)
+    # Outputs as (variables, file without suffix, layout): one per variable or one combined table
+    if output_format == 'combined':
+        if output_dir is None:
+            output_dir = create_save_folder(root_dir, 'Prism/Variables')
+        outputs = [(list(var_names), os.path.join(output_dir, f'Prism_{year}'), 'long')]
+    else:
+        outputs = []
+        for var_name in var_names:
+            var_dir = output_dir
+            if var_dir is None:
+                var_dir = create_save_folder(root_dir, f'Prism/Variables/{var_name}')
+            outputs.append(([var_name], os.path.join(var_dir, f'Prism_{var_name}_{year}'), output_format))
+    # Days to extract per output, all of the year unless only the missing ones are added to the existing output
+    days, existing = [], []
+    for names, output_file, layout in outputs:
+        output_days = list(range(len(date_vec)))
+        df_existing = None
+        if incremental:
+            df_existing, done_dates, output_mtime = read_daily_var(output_file, output_format=layout,
+                                                                   file_format=file_format)
+            done_dates = set(done_dates)
+            raster_mtimes = [[get_raster_mtime(root_dir, var_name, ymd, scale) for var_name in names]
+                             for ymd in num_dates]
+            output_days = [k for k in output_days if None not in raster_mtimes[k] and
+                           (date_vec[k] not in done_dates or max(raster_mtimes[k]) > output_mtime)]
+            n_updated = len([k for k in output_days if date_vec[k] in done_dates])
+            if len(output_days) == 0:
+                print(f'{", ".join(names)} for {year} is up to date with {len(done_dates)} days, nothing to extract')
+            else:
+                print(f'Adding {len(output_days) - n_updated} days and updating {n_updated} days of '
+                      f'{", ".join(names)} for {year} to {len(done_dates)} days already extracted')
+        days.append(output_days)
+        existing.append(df_existing)
+    var_days = {var_name: output_days for (names, _, _), output_days in zip(outputs, days) for var_name in names}
+    # Position of each day in the values of a variable
+    var_pos = {var_name: {k: j for j, k in enumerate(var_days[var_name])} for var_name in var_names}
+    # Values of all stations and days of each variable, filled column by column and materialized once
+    values = {var_name: None for var_name in var_names}
+    t0 = datetime.now()
+    # Station pixels are loaded once per grid geometry and reused for every day and variable sharing it
+    grid_key = None
+    print('-------------------------------------------------------------------------------')
+    for var_name in var_names:
+        cube_file = get_cube_path(root_dir, var_name, year, scale)
+        if len(var_days[var_name]) > 0 and os.path.isfile(cube_file):
+            # grids replaced after the cube was built, e.g., provisional days upgraded to stable, are read from the
+            # daily grids so their stale cube values are not written back
+            cube_mtime = os.path.getmtime(cube_file)
+            n_newer = len([k for k in var_days[var_name]
+                           if (get_raster_mtime(root_dir, var_name, num_dates[k], scale) or 0) > cube_mtime])
+            if n_newer > 0:
+                print(f'{var_name}: {n_newer} daily grids are newer than {cube_file}, reading the daily grids; '
+                      f'rerun build_cube.py to refresh the cube')
+                continue
+            # All days of the stations are read from the cube built by build_cube.py, one read per tile
+            with timed_stage('open', n_files=1):
+                cube = read_cube(cube_file)
+            with timed_stage('index'):
+                station_index = get_station_index(csv_file, df_stations, cube, station_index, sampling)
+            with timed_stage('read') as counts:
+                values[var_name] = read_cube_pixels(cube, station_index)[:, var_days[var_name]]
+                counts['bytes'] = values[var_name].nbytes
+            cube.close()
+            print(f'{var_name}: {len(var_days[var_name])} days read from the cube in '
+                  f'{round((datetime.now() - t0).total_seconds(), 3)} seconds ({n_stations} stations)')
+    # Remaining variables are read from the daily grids, all variables of a day together
+    loop_vars = [var_name for var_name in var_names if values[var_name] is None and len(var_days[var_name]) > 0]
+    loop_days = sorted(set(k for var_name in loop_vars for k in var_days[var_name]))
+    day_vars = [[var_name for var_name in loop_vars if k in var_pos[var_name]] for k in loop_days]
+    n_days = len(loop_days)
+    label = ", ".join(loop_vars)
+    if n_days > 0:
+        print_progress_bar(0, n_days, prefix='', suffix='', decimals=1, length=100, fill='█')
+    if workers > 1 and n_days > 0:
+        # Index is resolved (and saved) here from the first day so workers only receive and sample it
+        raster_data = read_bil_file(main_path=root_dir, var_name=day_vars[0][0], year=str(year),
+                                    ymd=num_dates[loop_days[0]], scale=scale)
+        with timed_stage('index'):
+            station_index = get_station_index(csv_file, df_stations, raster_data, station_index, sampling)
+        raster_data.close()
+        day_sampler = partial(sample_day, root_dir, year, scale, df_stations, station_index, sampling)
+        chunk_size = max(1, n_days // (workers * 4))
+        with worker_pool(workers) as executor:
+            # map returns days in order, so the table is identical to the serial one
+            day_values = executor.map(day_sampler, day_vars, [num_dates[k] for k in loop_days], chunksize=chunk_size)
+            for j, (value_lists, day_metrics) in enumerate(day_values):
+                k = loop_days[j]
+                merge_metrics(day_metrics)
+                for var_name, value_list in zip(day_vars[j], value_lists):
+                    if values[var_name] is None:
+                        values[var_name] = np.empty((n_stations, len(var_days[var_name])), dtype=value_list.dtype)
+                    values[var_name][:, var_pos[var_name][k]] = value_list
+                print_progress_bar(j + 1, n_days, prefix=f'{j + 1}/{n_days}',
+                                   suffix=f'{round((datetime.now() - t0).total_seconds(), 3)} '
+                                          f'seconds ({label} {date_vec[k]}, {n_stations} stations, {workers} workers)',
+                                   decimals=1, length=100, fill='█')
+    else:
+        for j, k in enumerate(loop_days):
+            for var_name in day_vars[j]:
+                with timed_stage('open', n_files=1):
+                    raster_data = read_bil_file(main_path=root_dir, var_name=var_name, year=str(year),
+                                                ymd=num_dates[k], scale=scale)
+                # raster_info(raster_data)
+                # show(raster_data)
+                # convert coordinates to raster row/col only when the grid geometry changes
+                raster_key = (raster_data.crs, raster_data.transform, raster_data.shape)
+                if raster_key != grid_key:
+                    with timed_stage('index'):
+                        station_index = get_station_index(csv_file, df_stations, raster_data, station_index,
+                                                          sampling)
+                    grid_key = raster_key
+                # read the band once and get value of all stations from grid
+                with timed_stage('read') as counts:
+                    band = raster_data.read(1)
+                    counts['bytes'] = band.nbytes
+                with timed_stage('sample'):
+                    value_list = sample_band(band, station_index, nodata=raster_data.nodata)
+                raster_data.close()
+                if values[var_name] is None:
+                    values[var_name] = np.empty((n_stations, len(var_days[var_name])), dtype=value_list.dtype)
+                values[var_name][:, var_pos[var_name][k]] = value_list
+            print_progress_bar(j + 1, n_days, prefix=f'{j + 1}/{n_days}',
+                               suffix=f'{round((datetime.now() - t0).total_seconds(), 3)} '
+                                      f'seconds ({label} {date_vec[k]}, {n_stations} stations)',
+                               decimals=1, length=100, fill='█')
+    print('-------------------------------------------------------------------------------')
+    for (names, output_file, layout), output_days, df_existing in zip(outputs, days, existing):
+        if len(output_days) == 0:
+            continue
+        value_list = [values[var_name] for var_name in names]
+        output_file = write_daily_var(df_day, value_list if len(names) > 1 else value_list[0],
+                                      [date_vec[k] for k in output_days], output_file,
+                                      names if len(names) > 1 else names[0], output_format=layout,
+                                      file_format=file_format, df_existing=df_existing)
+        print(f'Extraction of {", ".join(names)} for {year} is completed and saved in {output_file}')
+    print('-------------------------------------------------------------------------------')
+    return station_index
+
+
+def extract_daily_var(root_dir, year, var_name, station_file=None, output_dir=None, scale='daily', station_index=None,
+                      workers=1, output_format='wide', file_format='csv', incremental=False, sampling='nearest',
+                      polygon_file=None, polygon_id=None):
     """
     Extract daily attribute value based on the coordinates listed in `station_file`
     :param output_dir: Directory where extracted data is saved. Optional and comes when station_file is given
@@ -33,54 +314,21 @@ def extract_daily_var(root_dir, year, var_name, station_file=None, output_dir=No
                 vpdmax: maximum vapour pressure deficit,
                 vpdmin: minimum vapour presser deficit'
     :param station_file: Optional. If specify, use user defined file with list of stations
-    :return: Saves daily values of attribute chosen ove a year
+    :param station_index: Optional. Station to pixel index returned by a previous call, reused when still valid
+    :param workers: Number of processes the days are spread over. 1 runs serially in the current process
+    :param output_format: wide (one column per day) or long (one row per station and day), see write_daily_var
+    :param file_format: csv (default) or parquet
+    :param incremental: If True, only the downloaded days that are missing from an existing output, or whose raster
+                changed since it was written (e.g., a provisional grid replaced by the stable one), are extracted
+                and merged into it
+    :param sampling: nearest pixel (default), bilinear interpolation between the four surrounding pixel centers, or
+                area average over the polygons of polygon_file; weights are computed once and saved, see
+                get_station_weights
+    :param polygon_file: Polygons sampled instead of the stations when sampling is area, e.g., subbasins
+    :param polygon_id: Attribute of polygon_file holding the unique id of each polygon
+    :return: Saves daily values of attribute chosen ove a year and returns the station to pixel index
     """
-    # Get list of station based on the hard coded year
-    csv_file, df_stations = get_station_list(main_path=root_dir, station_file=station_file, var_name=var_name)
-    station_list = df_stations.Name.values
-    # Define  dataframe with geographic information
-    df_day = df_stations[['stnid', 'Name', 'Longitude', 'Latitude', 'Elevation(m)']]
-    # Define where to save extracted data and define file name
-    if output_dir is None:
-        output_dir = create_save_folder(root_dir, f'Prism/Variables/{var_name}')
-    output_file = os.path.join(output_dir, f'Prism_{var_name}_{year}.csv')
-    # Get series of date formatted in PRISM repository
-    num_dates, date_vec = get_date_vec(year, scale)
-    # number of days in a year and stations
-    n_days, n_stations = len(date_vec), len(station_list)
-    total_loops = n_stations * n_days
-    t0 = datetime.now()
-    m = 0
-    print('-------------------------------------------------------------------------------')
-    print_progress_bar(m, total_loops, prefix='', suffix='', decimals=1, length=100, fill='█')
-    for k in range(n_days):
-        raster_data = read_bil_file(main_path=root_dir, var_name=var_name, year=str(year),
-                                    ymd=num_dates[k], scale=scale)
-        # raster_info(raster_data)
-        # show(raster_data)
-        # convert coordinate to raster projection
-        transformer = Transformer.from_crs("EPSG:4326", raster_data.crs, always_xy=True)
-        lat_list, lon_list, value_list = [], [], []
-        for stn in station_list:
-            lon, lat = get_lon_lat(df=df_stations, station=stn)
-            lon_list.append(lon)
-            lat_list.append(lat)
-            xx, yy = transformer.transform(lon, lat)
-            # get value from grid
-            value = list(raster_data.sample([(xx, yy)]))[0]
-            value_list.append(value[0])
-            # print(f'{date_vec[k]} ppt for {stn}: {value[0]}')
-            print_progress_bar(m+1, total_loops, prefix=f'{m}/{total_loops}',
-                               suffix= f'{round((datetime.now() - t0).total_seconds(), 3)} '
-                                       f'seconds ({date_vec[k]}, {stn})', decimals=1, length=100, fill='█')
-            m +=1
-            # print_progress_bar(m, total_loops, prefix=f'{m}/{total_loops}',
-            #                    suffix=f'For {stn}: {date_vec[k]} took  '
-            #                           f'{round((datetime.now() - t0).total_seconds(), 3)} seconds',
-            #                    decimals=1, length=100, fill='█')
-        print('-------------------------------------------------------------------------------')
-        df_day_values = pd.DataFrame({f'{date_vec[k]}': value_list}, index=df_day.index)
-        df_day = pd.concat([df_day, df_day_values], axis=1)
-    df_day.to_csv(output_file)
-    print(f'Extraction of {var_name} for {year} is completed and saved in {output_file}')
-    print('-------------------------------------------------------------------------------')
\ No newline at end of file
+    return extract_daily_vars(root_dir, year, [var_name], station_file=station_file, output_dir=output_dir,
+                              scale=scale, station_index=station_index, workers=workers, output_format=output_format,
+                              file_format=file_format, incremental=incremental, sampling=sampling,
+                              polygon_file=polygon_file, polygon_id=polygon_id)
@@ -0,0 +1,150 @@
+"""
+    Program: Zonal statistics of PRISM grids over polygons such as counties or subbasins
+    Author: Mahesh Lal Maskey, Ph.D. in Hydrologic Sciences
+    Affiliations: USDA-ARS, Sustainable Water Management Research Unit, Stoneville/Leland MS
+                  University of California, Davis, Department of Land, Air, and Water Resources
+    E-mail: mahesh.maskey@usda.gov/mmaskey@ucdavis.edu
+"""
+# Syntax: python extract_zonal_stats.py --root_dir='path/to/downloaded_PRISM_data' --start_year=1981 --end_year=2023
+# --attributes ppt tmax --zone_file=counties.shp --zone_id=GEOID --stats mean min max --output_dir='path/to/save_dir'
+
+import argparse
+import os
+import numpy as np
+from datetime import datetime
+from functools import partial
+from extract_daily_var import write_daily_var
+from Utility import create_save_folder
+from Utility import get_date_vec
+from Utility import get_zone_index
+from Utility import get_zone_labels
+from Utility import get_zone_list
+from Utility import merge_metrics
+from Utility import print_progress_bar
+from Utility import read_day_grids
+from Utility import read_bil_file
+from Utility import report_metrics
+from Utility import timed_stage
+from Utility import worker_pool
+from Utility import zonal_stats
+
+
+def reduce_day(root_dir, year, scale, gdf_zones, zone_index, var_names, stats, ymd):
+    """
+    Reads the grids of one day and reduces them over the zones. Run by the worker processes of extract_zonal_stats
+    :return: List with the statistics of each variable, as returned by zonal_stats, and the metrics of the day
+    """
+    def index_grid(raster, fingerprint):
+        pixels, labels = get_zone_labels(raster, gdf_zones)
+        return {'pixels': pixels, 'labels': labels, 'ids': zone_index['ids'], 'digest': zone_index['digest'],
+                'fingerprint': fingerprint}
+
+    return read_day_grids(root_dir, year, scale, var_names, ymd, zone_index, zone_index['fingerprint'], index_grid,
+                          partial(zonal_stats, stats=stats), 'reduce')
+
+
+def extract_zonal_stats(root_dir, year, var_names, zone_file, zone_id, output_dir=None, scale='daily',
+                        stats=('mean',), zone_index=None, workers=1, output_format='wide', file_format='csv'):
+    """
+    Computes daily statistics of each zone from the grids. The zones are rasterized once into a label grid cached per
+    grid fingerprint, so each day is a handful of bincount reductions over the labeled pixels.
+    :param root_dir: Directory where the Prism data were downloaded
+    :param var_names: List of variables, e.g., ['ppt', 'tmax']
+    :param zone_file: Polygons, e.g., counties or subbasins, relative to root_dir unless absolute
+    :param zone_id: Attribute of zone_file holding the unique id of each zone
+    :param stats: Any of mean, min, max, sum and count; one output Prism_<variable>_<stat>_<year> per statistic
+    :param zone_index: Optional. Zone index returned by a previous call, reused when still valid
+    :param workers: Number of processes the days are spread over. 1 runs serially in the current process
+    :param output_format: wide (one column per day) or long (one row per zone and day), see write_daily_var
+    :param file_format: csv (default) or parquet
+    :return: Zone index
+    """
+    zone_file_path, gdf_zones = get_zone_list(root_dir, zone_file, zone_id)
+    df_info = gdf_zones[['Name']]
+    num_dates, date_vec = get_date_vec(year, scale)
+    n_days, n_zones = len(num_dates), len(gdf_zones)
+    values = {(var_name, stat): None for var_name in var_names for stat in stats}
+    t0 = datetime.now()
+    print('-------------------------------------------------------------------------------')
+    print_progress_bar(0, n_days, prefix='', suffix='', decimals=1, length=100, fill='█')
+
+    def store(k, results, day_metrics):
+        merge_metrics(day_metrics)
+        for var_name, result in zip(var_names, results):
+            for stat in stats:
+                if values[(var_name, stat)] is None:
+                    values[(var_name, stat)] = np.empty((n_zones, n_days), dtype=result[stat].dtype)
+                values[(var_name, stat)][:, k] = result[stat]
+        print_progress_bar(k + 1, n_days, prefix=f'{k + 1}/{n_days}',
+                           suffix=f'{round((datetime.now() - t0).total_seconds(), 3)} '
+                                  f'seconds ({date_vec[k]}, {n_zones} zones)', decimals=1, length=100, fill='█')
+
+    # Zones are rasterized (or loaded) here from the first day so workers only receive and reduce them
+    raster_data = read_bil_file(main_path=root_dir, var_name=var_names[0], year=str(year), ymd=num_dates[0],
+                                scale=scale)
+    with timed_stage('index'):
+        zone_index = get_zone_index(zone_file_path, gdf_zones, raster_data, zone_index)
+    raster_data.close()
+    day_reducer = partial(reduce_day, root_dir, year, scale, gdf_zones, zone_index, var_names, stats)
+    if workers > 1:
+        chunk_size = max(1, n_days // (workers * 4))
+        with worker_pool(workers) as executor:
+            # map returns days in order, so the tables are identical to the serial ones
+            for k, (results, day_metrics) in enumerate(executor.map(day_reducer, num_dates, chunksize=chunk_size)):
+                store(k, results, day_metrics)
+    else:
+        for k in range(n_days):
+            store(k, *day_reducer(num_dates[k]))
+    print('-------------------------------------------------------------------------------')
+    for var_name in var_names:
+        var_dir = output_dir
+        if var_dir is None:
+            var_dir = create_save_folder(root_dir, f'Prism/Zones/{var_name}')
+        for stat in stats:
+            output_file = os.path.join(var_dir, f'Prism_{var_name}_{stat}_{year}')
+            output_file = write_daily_var(df_info, values[(var_name, stat)], date_vec, output_file, var_name,
+                                          output_format=output_format, file_format=file_format)
+            print(f'Zonal {stat} of {var_name} for {year} is completed and saved in {output_file}')
+    print('-------------------------------------------------------------------------------')
+    return zone_index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Daily zonal statistics of PRISM grids over polygons such as counties or subbasins."
+    )
+    parser.add_argument('--root_dir', type=str, required=True, help='Download folder')
+    parser.add_argument('--start_year', type=int, required=True, help='Beginning of year to process')
+    parser.add_argument('--end_year', type=int, required=True, help='End of year to process')
+    parser.add_argument('--attributes', type=str, nargs='+', required=True,
+                        help='PRISM attributes: ppt tmin tdmean tmax vpdmin vpdmax')
+    parser.add_argument('--zone_file', type=str, required=True, help='Polygons, e.g., counties or subbasins')
+    parser.add_argument('--zone_id', type=str, required=True, help='Attribute holding the unique id of each zone')
+    parser.add_argument('--stats', type=str, nargs='+', default=['mean'],
+                        help='Statistics per zone: mean (default), min, max, sum, count')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='Directory where the statistics are saved. Default Prism/Zones/<attribute>')
+    parser.add_argument('--scale', type=str, default='daily', help='Time scale: daily or monthly')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes the days of each year are spread over. Default 1 (serial)')
+    parser.add_argument('--output_format', type=str, default='wide',
+                        help='Layout of the yearly output: wide (one column per day, default) or long')
+    parser.add_argument('--file_format', type=str, default='csv',
+                        help='File format of the yearly output: csv (default) or parquet')
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='JSON file where the seconds, calls, bytes and files of each stage of the run are saved')
+    args = parser.parse_args()
+    t0 = datetime.now()
+
+    # Zone label grid is built once and reused for all years while the grid does not change
+    zone_index = None
+    for year in range(args.start_year, args.end_year + 1):
+        zone_index = extract_zonal_stats(args.root_dir, year, args.attributes, args.zone_file, args.zone_id,
+                                         output_dir=args.output_dir, scale=args.scale, stats=args.stats,
+                                         zone_index=zone_index, workers=args.workers,
+                                         output_format=args.output_format, file_format=args.file_format)
+    report_metrics(t0, metrics_file=args.metrics_file, script='extract_zonal_stats', args=vars(args))
+
+
+if __name__ == '__main__':
+    main()
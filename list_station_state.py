@@ -4,7 +4,7 @@ import os
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from Utility import create_save_folder
-from Utility import get_list
+from Utility import get_lists_by_state
 
 file_shp = '../../Spatial_dataset/US_State/tl_2021_us_state.shp'
 out_dir = create_save_folder(root_dir='D:/Maskey/Data_analysis/PRISM', sub_dir='Spatial_data')
@@ -16,27 +16,16 @@ state_name = 'Mississippi'
 out_dir = create_save_folder(root_dir=out_dir, sub_dir=state_name)
 data_dir = 'path/to/Data/Folder/'
 
-df_station_ppt, gdf_STATE_ppt, gdf_state_ppt, df_state_ppt = get_list(gdf_US, data_dir=data_dir, save_dir=out_dir,
-                                                                      state_name=state_name, station_file=None,
-                                                                      var_name='ppt')
-df_station_tmin, gdf_STATE_tmin, gdf_state_tmin, df_state_tmin = get_list(gdf_US, data_dir=data_dir, save_dir=out_dir,
-                                                                          state_name=state_name, station_file=None,
-                                                                          var_name='tmin')
-df_station_tdmean, gdf_STATE_tdmean, gdf_state_tdmean, df_state_tdmean = get_list(gdf_US, data_dir=data_dir,
-                                                                                  save_dir=out_dir,
-                                                                                  state_name=state_name,
-                                                                                  station_file=None, var_name='tdmean')
-df_station_tmax, gdf_STATE_tmax, gdf_state_tmax, df_state_tmax = get_list(gdf_US, data_dir=data_dir,
-                                                                          save_dir=out_dir, state_name=state_name,
-                                                                          station_file=None, var_name='tmax')
-df_station_vpdmin, gdf_STATE_vpdmin, gdf_state_vpdmin, df_state_vpdmin = get_list(gdf_US, data_dir=data_dir,
-                                                                                  save_dir=out_dir,
-                                                                                  state_name=state_name,
-                                                                                  station_file=None, var_name='vpdmin')
-df_station_vpdmax, gdf_STATE_vpdmax, gdf_state_vpdmax, df_state_vpdmax = get_list(gdf_US,
-                                                                                  data_dir=data_dir, save_dir=out_dir,
-                                                                                  state_name=state_name,
-                                                                                  station_file=None, var_name='ppt')
+var_names = ['ppt', 'tmin', 'tdmean', 'tmax', 'vpdmin', 'vpdmax']
+# Station lists of all variables are assigned to the states in one spatial join
+stations, lists = get_lists_by_state(gdf_US, data_dir=data_dir, state_names=[state_name], save_dir=out_dir,
+                                     station_file=None, var_names=var_names)
+gdf_STATE_ppt, gdf_state_ppt, df_state_ppt = lists[(state_name, 'ppt')]
+gdf_STATE_tmin, gdf_state_tmin, df_state_tmin = lists[(state_name, 'tmin')]
+gdf_STATE_tdmean, gdf_state_tdmean, df_state_tdmean = lists[(state_name, 'tdmean')]
+gdf_STATE_tmax, gdf_state_tmax, df_state_tmax = lists[(state_name, 'tmax')]
+gdf_STATE_vpdmin, gdf_state_vpdmin, df_state_vpdmin = lists[(state_name, 'vpdmin')]
+gdf_STATE_vpdmax, gdf_state_vpdmax, df_state_vpdmax = lists[(state_name, 'vpdmax')]
 fig, ax = plt.subplots(figsize=(12, 8))
 gdf_US.plot(ax=ax, facecolor='none', edgecolor='black')
 gdf_STATE_ppt.plot(ax=ax, facecolor='none', edgecolor='red')
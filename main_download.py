@@ -9,11 +9,15 @@
 
 import argparse
 import os
+from datetime import datetime
 from pathlib import Path
 from Utility import create_save_folder
+from Utility import report_metrics
+from downloadPrismBill import check_downloads
 from downloadPrismBill import download_prism_bill
+from downloadPrismBill import format_date_ranges
 # Syntax: python main_download --dir2Save='path/to/Data/Folder' --start_year=1981 --end_year=2023
-# --scale=daily --attribute=ppt
+# --scale=daily --attribute=ppt --workers=4
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -42,15 +46,68 @@ parser.add_argument(
          'tmin: minimum temperature, vpdmax: maximum vapor pressure deficit, vpdmin: minimum vapor pressure deficit'
 )
 
+parser.add_argument(
+    '--workers', type=int, default=4,
+    help='Number of files downloaded concurrently. Default 4'
+)
+
+parser.add_argument(
+    '--retries', type=int, default=3,
+    help='Attempts per file on network errors, with exponential backoff. Default 3'
+)
+
+parser.add_argument(
+    '--skip_extract', action='store_true',
+    help='Keep the downloaded zips only; extraction then reads the rasters straight from the archives'
+)
+
+parser.add_argument(
+    '--incremental', action='store_true',
+    help='Only fetch dates released since the last run; dates after today are not requested'
+)
+
+parser.add_argument(
+    '--checksum', action='store_true',
+    help='Re-hash archives recorded in the manifest instead of trusting their size'
+)
+
+parser.add_argument(
+    '--check_only', action='store_true',
+    help='Only verify the archives against the manifest, without network access, and report the gaps'
+)
+
+parser.add_argument(
+    '--metrics_file', type=str, default=None,
+    help='JSON file where the seconds, calls, bytes and files of each stage of the run are saved'
+)
+
 args = parser.parse_args()
+t0 = datetime.now()
 start_year = int(args.start_year)
 end_year = int(args.end_year)
 scale = str(args.scale)
 var_name = str(args.attribute)
+workers = int(args.workers)
+retries = int(args.retries)
+extract = not args.skip_extract
+incremental = args.incremental
 
 src_dir = Path(os.path.dirname(os.path.realpath(__file__)))
 output_dir = Path(args.dir2Save)
 
 save_dir = create_save_folder(root_dir=output_dir, sub_dir='Prism')
+gaps = {}
 for year in range(start_year, end_year + 1):
-    download_prism_bill(scale, var_name, year, dir2save=save_dir)
+    if args.check_only:
+        gaps[year] = check_downloads(scale, var_name, year, dir2save=save_dir, checksum=args.checksum)
+        continue
+    missing, failed = download_prism_bill(scale, var_name, year, dir2save=save_dir, workers=workers, retries=retries,
+                                          extract=extract, incremental=incremental, checksum=args.checksum)
+    gaps[year] = sorted(missing + failed)
+# Summary of the dates still missing, a rerun only fetches these
+for year, dates in gaps.items():
+    if dates:
+        print(f'{year}: {len(dates)} dates without a verified archive: {format_date_ranges(dates)}')
+if not any(gaps.values()):
+    print(f'All {var_name} archives from {start_year} to {end_year} are verified')
+report_metrics(t0, metrics_file=args.metrics_file, script='main_download', args=vars(args))
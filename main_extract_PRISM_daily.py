@@ -8,65 +8,138 @@
 """
 # Syntax: python main_extract_PRISM_daily.py --root_dir='path/to/downloaded_PRISM_data' --start_year=1981
 # --end_year=2023 --attribute=ppt --station_file=''/<file.name.csv> ----output_dir='path/to/save_dir' --scale=daily
+# --workers=4
+# Several attributes in one pass: --attributes ppt tmin tmax tdmean vpdmin vpdmax
 
 import argparse
 import os
+from datetime import datetime
 from pathlib import Path
-from extract_daily_var import extract_daily_var
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    '--root_dir', type=str, required=True,
-    help='Download folder'
-)
-
-parser.add_argument(
-    '--start_year', type=int, required=True,
-    help='Beginning of year to process'
-)
-
-parser.add_argument(
-    '--end_year', type=int, required=True,
-    help='End of year to process'
-)
-
-parser.add_argument(
-    '--attribute', type=str, required=True,
-    help='Parameter to download, e.g., ppt for precipitation, tdmain: mean temperature, tmax: maximum temperature,'
-         'tmin: minimum temperature, vpdmax: maximum vapour pressure deficit, vpdmin: minimum vapour presser deficit'
-)
-
-parser.add_argument(
-    '--station_file', type=str, required=True,
-    help='Parameter to download, e.g., ppt for precipitation, tdmain: mean temperature, tmax: maximum temperature,'
-         'tmin: minimum temperature, vpdmax: maximum vapour pressure deficit, vpdmin: minimum vapour presser deficit'
-)
-
-parser.add_argument(
-    '--output_dir', type=str, required=True,
-    help='Directory where extracted data is saved. Optional and comes when station_file is given'
-)
-
-parser.add_argument(
-    '--scale', type=str, required=True,
-    help='Directory where extracted data is saved. Optional and comes when station_file is given'
-)
-
-args = parser.parse_args()
-start_year = int(args.start_year)
-end_year = int(args.end_year)
-var_name = str(args.attribute)
-scale = str(args.scale)
-station_file = str(args.station_file)
-if station_file == 'None':
-    station_file = None
-output_dir = str(args.output_dir)
-if output_dir == 'None':
-    output_dir = None
-
-src_dir = Path(os.path.dirname(os.path.realpath(__file__)))
-root_dir = Path(args.root_dir)
-
-for year in range(start_year, end_year + 1):
-    extract_daily_var(root_dir, year, var_name, station_file=station_file, output_dir=output_dir, scale=scale)
+from extract_daily_var import extract_daily_vars
+from Utility import report_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--root_dir', type=str, required=True,
+        help='Download folder'
+    )
+
+    parser.add_argument(
+        '--start_year', type=int, required=True,
+        help='Beginning of year to process'
+    )
+
+    parser.add_argument(
+        '--end_year', type=int, required=True,
+        help='End of year to process'
+    )
+
+    parser.add_argument(
+        '--attribute', type=str, default=None,
+        help='Parameter to download, e.g., ppt for precipitation, tdmain: mean temperature, tmax: maximum temperature,'
+             'tmin: minimum temperature, vpdmax: maximum vapour pressure deficit, vpdmin: minimum vapour presser deficit'
+    )
+
+    parser.add_argument(
+        '--attributes', type=str, nargs='+', default=None,
+        help='Several parameters extracted in a single pass sharing the station to pixel index, e.g., '
+             '--attributes ppt tmin tmax tdmean vpdmin vpdmax'
+    )
+
+    parser.add_argument(
+        '--station_file', type=str, required=True,
+        help='Parameter to download, e.g., ppt for precipitation, tdmain: mean temperature, tmax: maximum temperature,'
+             'tmin: minimum temperature, vpdmax: maximum vapour pressure deficit, vpdmin: minimum vapour presser deficit'
+    )
+
+    parser.add_argument(
+        '--output_dir', type=str, required=True,
+        help='Directory where extracted data is saved. Optional and comes when station_file is given'
+    )
+
+    parser.add_argument(
+        '--scale', type=str, required=True,
+        help='Directory where extracted data is saved. Optional and comes when station_file is given'
+    )
+
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of processes the days of each year are spread over, e.g. $SLURM_CPUS_PER_TASK. Default 1 (serial)'
+    )
+
+    parser.add_argument(
+        '--output_format', type=str, default='wide',
+        help='Layout of the yearly output: wide (one column per day, default), long (one row per station and day) '
+             'or combined (one long table Prism_<year>_long with a column per attribute)'
+    )
+
+    parser.add_argument(
+        '--file_format', type=str, default='csv',
+        help='File format of the yearly output: csv (default) or parquet'
+    )
+
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Only extract the downloaded days missing from existing outputs and add them, e.g., for nightly updates'
+    )
+
+    parser.add_argument(
+        '--sampling', type=str, default='nearest',
+        help='nearest pixel (default), bilinear between the four surrounding pixel centers, or area average over the '
+             'polygons of --polygon_file'
+    )
+
+    parser.add_argument(
+        '--polygon_file', type=str, default=None,
+        help='Polygons (e.g., subbasins) sampled instead of the stations with --sampling=area'
+    )
+
+    parser.add_argument(
+        '--polygon_id', type=str, default=None,
+        help='Attribute of --polygon_file holding the unique id of each polygon'
+    )
+
+    parser.add_argument(
+        '--metrics_file', type=str, default=None,
+        help='JSON file where the seconds, calls, bytes and files of each stage of the run are saved'
+    )
+
+    args = parser.parse_args()
+    t0 = datetime.now()
+    if args.attributes is None and args.attribute is None:
+        parser.error('one of --attribute or --attributes is required')
+    if args.sampling == 'area' and (args.polygon_file is None or args.polygon_id is None):
+        parser.error('--sampling=area requires --polygon_file and --polygon_id')
+    start_year = int(args.start_year)
+    end_year = int(args.end_year)
+    var_names = args.attributes if args.attributes is not None else [str(args.attribute)]
+    scale = str(args.scale)
+    workers = int(args.workers)
+    output_format = str(args.output_format)
+    file_format = str(args.file_format)
+    station_file = str(args.station_file)
+    if station_file == 'None':
+        station_file = None
+    output_dir = str(args.output_dir)
+    if output_dir == 'None':
+        output_dir = None
+
+    src_dir = Path(os.path.dirname(os.path.realpath(__file__)))
+    root_dir = Path(args.root_dir)
+
+    # Station to pixel index is built once and reused for all years and attributes while the grid does not change
+    station_index = None
+    for year in range(start_year, end_year + 1):
+        station_index = extract_daily_vars(root_dir, year, var_names, station_file=station_file, output_dir=output_dir,
+                                           scale=scale, station_index=station_index, workers=workers,
+                                           output_format=output_format, file_format=file_format,
+                                           incremental=args.incremental, sampling=args.sampling,
+                                           polygon_file=args.polygon_file, polygon_id=args.polygon_id)
+    report_metrics(t0, metrics_file=args.metrics_file, script='main_extract_PRISM_daily', args=vars(args))
+
+
+# Guard is required by the worker processes, which re-import this module on spawn platforms
+if __name__ == '__main__':
+    main()
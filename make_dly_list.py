@@ -1,6 +1,6 @@
 import pandas as pd
-import re
 import fortranformat as ff
+from Utility import get_station_file_name
 
 df_stn_list = pd.read_csv('Spatial_data/Shapefile/Mississippi/Mississippi_weather_stations.csv')
 file_list = 'Weather_Data/Mississippi/WDLYLIST.DAT'
@@ -10,12 +10,8 @@ f_w.close()
 for i in range(df_stn_list.shape[0]):
     f_a = open(file_list, 'a')
     stn = df_stn_list.loc[df_stn_list.index[i], 'Name']
-    file = ''.join(re.findall(r'[a-zA-Z]+', stn))
-    # if '/' in stn:
-    #     file = stn.split('/')
-    #     file = file[0] + file[1]
-    # else:
-    #     file = stn
+    # weather files are named after the unique station id by convert_weather.py
+    file = get_station_file_name(df_stn_list.loc[df_stn_list.index[i], 'Station'])
     file_name = f'{file}.dly'
     Longitude = df_stn_list.loc[df_stn_list.index[i], 'Longitude']
     Latitude = df_stn_list.loc[df_stn_list.index[i], 'Latitude']
@@ -3,18 +3,11 @@
 # Date: September 14, 2023
 # Affiliations: USDA-ARS, SWMRU, UC Davis, LAWR, Hydrologic Sciences (2012-2019)
 
-import requests
 import os
 import shutil
 import pandas as pd
-import geopandas as gpd
 from datetime import datetime
-from pyproj import Transformer, Proj, CRS
-from shapely.geometry import Polygon
-from osgeo import gdal  # include imports with the function definition (not where you call it)
-from osgeo import osr
-from osgeo import ogr
-import rasterio
+# geopandas, rasterio, pyproj, shapely, requests and GDAL are imported by the functions using them
 # import rioxarray
 # from rioxarray.merge import merge_arrays
 
@@ -67,6 +60,9 @@ def raster_info(raster):
         GEOGCS gives you the geographic coordinate system (horizontal/angular: latitude and longitude in degrees).
         VERT_CS gives you the vertical coordinate system (vertical/linear: elevation or depth in linear units like meters or feet).
     """
+    import rasterio
+    from osgeo import gdal
+    from osgeo import osr
     # Check the type of raster input
     if isinstance(raster, rasterio.io.DatasetReader):  # you can directly access the crs attribute of the raster dataset
         raster_detail = raster.crs.wkt
@@ -110,6 +106,7 @@ def raster_info(raster):
 
 
 def trans_lin2ang(crs_from, crs_to, x, y):
+    from pyproj import Transformer
     transformer = Transformer.from_crs(crs_from, crs_to)
     x, y = transformer.transform(x, y)
     return x, y
@@ -123,6 +120,7 @@ def create_save_folder(root_dir, sub_dir):
 
 
 def request_save(url_path, out_dir, is_display=True):
+    import requests
     imfile = url_path.split('/')[-1]
     imfile = imfile[-14:].upper()
     file_path_2save = os.path.join(out_dir, imfile)
@@ -191,6 +189,7 @@ def clip_buffer_shp(gdf, field, offset):
 
 def read_grid(dir_read, file):
     # Import grid information and relevant database
+    import geopandas as gpd
     shape_file = os.path.join(dir_read, f'{file}.shp')
     df_file = os.path.join(dir_read, f'{file}.csv')
     gdf = gpd.read_file(shape_file, index_col=0)
@@ -201,6 +200,7 @@ def read_grid(dir_read, file):
 
 
 def read_shape_project(dir_read, file):
+    import geopandas as gpd
     shape_file = os.path.join(dir_read, f'{file}.shp')
     gdf = gpd.read_file(shape_file, index_col=0)
     return gdf
@@ -216,6 +216,7 @@ def clip_DataFrame(shp, df_grid):
 
 
 def clip_grid(df, grid_shp):
+    import geopandas as gpd
     list_tile, file_lists = df.Tile.values, df.full_path.values
     sub_grid = gpd.GeoDataFrame()
     for tile in list_tile:
@@ -244,6 +245,7 @@ def clip_grid(df, grid_shp):
 
 
 def read_raster(dir_path, imfile):
+    import rasterio
     imfilepath = os.path.join(dir_path, imfile)
     raster = rasterio.open(imfilepath)
     crs_linear, crs_angular = raster_info(raster)
@@ -251,6 +253,8 @@ def read_raster(dir_path, imfile):
 
 
 def make_rectangle(x1, y1, x2, y2, crs):
+    import geopandas as gpd
+    from shapely.geometry import Polygon
     lat_point_list = [y1, y1, y2, y2, y1]
     lon_point_list = [x1, x2, x2, x1, x1]
     polygon_geom = Polygon(zip(lon_point_list, lat_point_list))
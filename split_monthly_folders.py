@@ -1,9 +1,12 @@
 import argparse
 import os
+from datetime import datetime
 from pathlib import Path
-from Utility import split_month_folder
+from Utility import SPLIT_MODES
+from Utility import report_metrics
+from Utility import split_month_folders
 # syntax python split_monthly_folders.py --root_dir=X:/Mahesh.Maskey/Data/Climate --start_year=1895
-# --end_year=1981 --scale=monthly --attribute=tmax
+# --end_year=1981 --scale=monthly --attribute=tmax --mode=hardlink --workers=4
 parser = argparse.ArgumentParser()
 parser.add_argument(
     '--root_dir', type=str, required=True,
@@ -17,7 +20,7 @@ parser.add_argument(
 
 parser.add_argument(
     '--end_year', type=int, required=True,
-    help='End of year to process'
+    help='End of year to process, not included'
 )
 
 parser.add_argument(
@@ -31,7 +34,24 @@ parser.add_argument(
          'tmin: minimum temperature, vpdmax: maximum vapour pressure deficit, vpdmin: minimum vapour presser deficit'
 )
 
+parser.add_argument(
+    '--mode', type=str, default='hardlink', choices=SPLIT_MODES,
+    help='How files are placed into the month folders: hardlink (default, no extra disk space; copies when the '
+         'drive does not support links), symlink, move or copy'
+)
+
+parser.add_argument(
+    '--workers', type=int, default=1,
+    help='Number of years split at the same time. Default 1'
+)
+
+parser.add_argument(
+    '--metrics_file', type=str, default=None,
+    help='JSON file where the seconds and files of each stage of the run are saved'
+)
+
 args = parser.parse_args()
+t0 = datetime.now()
 start_year = int(args.start_year)
 end_year = int(args.end_year)
 scale = str(args.scale)
@@ -39,5 +59,5 @@ var_name = str(args.attribute)
 src_dir = Path(os.path.dirname(os.path.realpath(__file__)))
 root_dir = Path(args.root_dir)
 
-for year in range(start_year, end_year):
-    split_month_folder(root_dir, scale, var_name, year)
+split_month_folders(root_dir, scale, var_name, range(start_year, end_year), mode=args.mode, workers=args.workers)
+report_metrics(t0, metrics_file=args.metrics_file, script='split_monthly_folders', args=vars(args))
@@ -0,0 +1,39 @@
+"""
+Pins the .dly writer against golden files written by the previous per-record FortranRecordWriter (write_line_ff)
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from Utility import convert2dly
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Ties of F6.1/F6.2 (rounded half away from zero), inexact decimals, -0.0, overflow, nodata, NaN and Inf
+VALUES = [25.0, 0.25, 0.35, -0.25, 0.05, 0.15, -0.0, -0.04, 99999.5, 9999.95, 9999.94, np.nan, np.inf, -np.inf,
+          -9999.0, 157.025, float(np.float32(157.025)), 1e-20, 12.345, -12.35, 0.75, 1.45, 36.6, 0.0]
+PPT = [0.0, 0.125, 0.375, 2.675, 0.005, 0.015, 999.995, 1000.0, 99.995, -0.0, -0.005, np.nan, np.inf, -9999.0,
+       float(np.float32(1.125)), float(np.float32(0.1)), 12.5, 3.14159, 0.625, 7.0, 250.255, 0.045, 1e-20, 45.5]
+
+
+def make_weather_frame(full=False):
+    """
+    Daily frame laid out like the ones convert_weather.py writes: Year, Month, Day, then the weather variables
+    :param full: Also include srad, rhum and wind, which the .dly layout leaves blank when missing
+    """
+    dates = pd.date_range('2020-02-20', periods=len(VALUES), freq='D')
+    columns = {'ppt': PPT, 'tmin': np.roll(VALUES, 5), 'tdmean': np.roll(VALUES, 9), 'tmax': VALUES}
+    if full:
+        columns.update({'srad': np.roll(VALUES, 3), 'rhum': np.roll(VALUES, 11), 'wind': np.roll(VALUES, 17)})
+    df = pd.DataFrame(columns, index=dates)
+    df.insert(0, 'Year', df.index.year)
+    df.insert(1, 'Month', df.index.month)
+    df.insert(2, 'Day', df.index.day)
+    return df
+
+
+@pytest.mark.parametrize('full, golden_file', [(False, 'golden.dly'), (True, 'golden_full.dly')])
+def test_convert2dly_matches_golden_file(tmp_path, full, golden_file):
+    dly_file = tmp_path / 'station.dly'
+    convert2dly(make_weather_frame(full), str(dly_file))
+    with open(os.path.join(DATA_DIR, golden_file), 'rb') as f:
+        assert dly_file.read_bytes() == f.read()
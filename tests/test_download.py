@@ -0,0 +1,81 @@
+"""
+Downloads against a local mirror of the PRISM repository, see download_prism_bill
+"""
+import functools
+import os
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from downloadPrismBill import download_prism_bill
+from downloadPrismBill import format_date_ranges
+from downloadPrismBill import get_manifest_path
+from downloadPrismBill import read_manifest
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    """
+    Serves tmp_path/mirror over HTTP, bypassing any proxy of the environment
+    """
+    for name in ['http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']:
+        monkeypatch.delenv(name, raising=False)
+    root_dir = tmp_path / 'mirror'
+    root_dir.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(root_dir)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root_dir, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def publish(root_dir, grade, dates, var_name='ppt'):
+    for ymd in dates:
+        year_dir = root_dir / 'daily' / var_name / ymd[:4]
+        year_dir.mkdir(parents=True, exist_ok=True)
+        stem = f'PRISM_{var_name}_{grade}_4kmD2_{ymd}_bil'
+        with zipfile.ZipFile(year_dir / f'{stem}.zip', 'w') as zf:
+            zf.writestr(f'{stem}.bil', grade)
+
+
+def test_format_date_ranges():
+    assert format_date_ranges(['20210103', '20210101', '20210102', '20210105']) == '20210101-20210103, 20210105'
+    assert format_date_ranges(['202012', '202101', '1980']) == '1980, 202012-202101'
+    assert format_date_ranges(['20210101 (x)', '20210102 (x)']) == '20210101 (x), 20210102 (x)'
+
+
+def test_upgrades_are_summarized(mirror, tmp_path, capsys):
+    root_dir, url_web = mirror
+    dates = ['20210102', '20210103', '20210105']
+    publish(root_dir, 'provisional', dates)
+    download_prism_bill('daily', 'ppt', 2021, str(tmp_path / 'Prism'), url_web=url_web, extract=False)
+    publish(root_dir, 'stable', dates)
+    capsys.readouterr()
+    download_prism_bill('daily', 'ppt', 2021, str(tmp_path / 'Prism'), url_web=url_web, extract=False)
+    out = capsys.readouterr().out
+    assert 'Replaced provisional with stable for 3 files: 20210102-20210103, 20210105' in out
+    zip_dir = tmp_path / 'Prism' / 'Zip_Folder' / 'daily' / 'ppt'
+    assert sorted(name for name in os.listdir(zip_dir) if name.endswith('.zip')) == \
+        [f'PRISM_ppt_stable_4kmD2_{ymd}_bil.zip' for ymd in dates]
+
+
+def test_resume_after_a_partial_manifest_line(mirror, tmp_path, capsys):
+    root_dir, url_web = mirror
+    dates = ['20210101', '20210102']
+    publish(root_dir, 'stable', dates)
+    download_prism_bill('daily', 'ppt', 2021, str(tmp_path / 'Prism'), url_web=url_web, extract=False)
+    # job killed while appending the record of the last date
+    manifest_path = get_manifest_path(str(tmp_path / 'Prism' / 'Zip_Folder' / 'daily' / 'ppt'))
+    with open(manifest_path, 'rb+') as f:
+        f.truncate(os.path.getsize(manifest_path) - 10)
+    assert len(read_manifest(manifest_path)) == 1
+    capsys.readouterr()
+    download_prism_bill('daily', 'ppt', 2021, str(tmp_path / 'Prism'), url_web=url_web, extract=False)
+    assert '2 files were already downloaded and skipped' in capsys.readouterr().out
+    assert sorted(read_manifest(manifest_path)) == dates
@@ -0,0 +1,58 @@
+"""
+The station and zone indexes are keyed by grid_fingerprint, so every reader of one grid must give the same one
+"""
+import os
+import zipfile
+import numpy as np
+from Utility import grid_fingerprint
+from Utility import read_bil_file
+
+# Sidecars as distributed with the PRISM 4 km grids
+HEADER = """BYTEORDER      I
+LAYOUT         BIL
+NROWS          3
+NCOLS          4
+NBANDS         1
+NBITS          32
+BANDROWBYTES   16
+TOTALROWBYTES  16
+PIXELTYPE      FLOAT
+ULXMAP         -125
+ULYMAP         49.9166666666664
+XDIM           0.0416666666667
+YDIM           0.0416666666667
+NODATA         -9999
+"""
+PRJ = ('GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,'
+       '298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+
+def write_prism_grid(root_dir, var_name='ppt', ymd='20200101'):
+    """
+    Writes one small grid both extracted under Prism/Variables and as its archive under Prism/Zip_Folder
+    """
+    stem = f'PRISM_{var_name}_stable_4kmD2_{ymd}_bil'
+    grid_dir = os.path.join(root_dir, 'Prism/Variables/daily', var_name, ymd)
+    zip_dir = os.path.join(root_dir, 'Prism/Zip_Folder/daily', var_name)
+    os.makedirs(grid_dir)
+    os.makedirs(zip_dir)
+    np.arange(12, dtype='<f4').tofile(os.path.join(grid_dir, f'{stem}.bil'))
+    with open(os.path.join(grid_dir, f'{stem}.hdr'), 'w') as f:
+        f.write(HEADER)
+    with open(os.path.join(grid_dir, f'{stem}.prj'), 'w') as f:
+        f.write(PRJ)
+    with zipfile.ZipFile(os.path.join(zip_dir, f'{stem}.zip'), 'w') as zf:
+        for ext in ['bil', 'hdr', 'prj']:
+            zf.write(os.path.join(grid_dir, f'{stem}.{ext}'), f'{stem}.{ext}')
+
+
+def test_readers_give_the_same_fingerprint(tmp_path):
+    write_prism_grid(str(tmp_path))
+    rasters = [read_bil_file(str(tmp_path), 'ppt', '2020', '20200101', 'daily', memmap=True),
+               read_bil_file(str(tmp_path), 'ppt', '2020', '20200101', 'daily', memmap=False),
+               read_bil_file(str(tmp_path), 'ppt', '2020', '20200101', 'daily', from_zip=True)]
+    assert type(rasters[0]).__name__ == 'BilRaster'
+    assert len({grid_fingerprint(raster) for raster in rasters}) == 1
+    assert all(np.array_equal(raster.read(1), rasters[0].read(1)) for raster in rasters)
+    for raster in rasters:
+        raster.close()
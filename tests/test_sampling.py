@@ -0,0 +1,27 @@
+"""
+Weighted sampling at the edge of the grid, see get_station_weights and apply_station_weights
+"""
+import numpy as np
+import pandas as pd
+from test_fingerprint import write_prism_grid
+from Utility import get_station_weights
+from Utility import read_bil_file
+from Utility import sample_band
+
+# Pixel centers of the 3 x 4 test grid start at -125, 49.9166666666664 (ULXMAP, ULYMAP) and are 1 / 24 degree apart
+PIXEL = 1 / 24
+
+
+def test_bilinear_edge_station_without_nodata(tmp_path):
+    write_prism_grid(str(tmp_path))
+    raster = read_bil_file(str(tmp_path), 'ppt', '2020', '20200101', 'daily')
+    # inside the grid, west of the first column of pixel centers and halfway between the first two rows
+    df_stations = pd.DataFrame({'Longitude': [-125 - PIXEL / 4], 'Latitude': [49.9166666666664 - PIXEL / 2]},
+                               index=['edge'])
+    df_weights = get_station_weights(raster, df_stations, 'bilinear')
+    band = raster.read(1)
+    raster.close()
+    assert (df_weights.col < 0).any()
+    # pixels outside the grid are left out rather than read as 0, the mean of band[0, 0] and band[1, 0]
+    assert np.allclose(sample_band(band, df_weights, nodata=None), [(band[0, 0] + band[1, 0]) / 2])
+    assert np.allclose(sample_band(band, df_weights, nodata=raster.nodata), [(band[0, 0] + band[1, 0]) / 2])
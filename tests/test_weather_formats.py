@@ -0,0 +1,26 @@
+"""
+Station files must not depend on the format of the concatenated series, see read_weather_data
+"""
+import numpy as np
+import pandas as pd
+from Utility import convert2dly
+from Utility import read_weather_data
+from Utility import write_table
+
+
+def test_csv_and_parquet_series_give_the_same_dly(tmp_path):
+    # grid values are float32; those with few decimals are ties of F6.1/F6.2 only as decimal text
+    values = np.float32([[157.025, 0.15, 2.675], [0.125, 12.35, -0.05], [np.nan, -9999.0, 1.005], [33.3, 0.0, 7.25]])
+    dates = pd.date_range('2021-06-01', periods=len(values), freq='D')
+    df = pd.DataFrame(values, index=dates.astype(str), columns=['ppt', 'tmin', 'tmax'])
+    dly_files = []
+    for file_format in ['csv', 'parquet']:
+        file_path = write_table(df, str(tmp_path / f'series_{file_format}'), file_format=file_format)
+        df_read = read_weather_data(file_path)
+        assert (df_read.dtypes == 'float64').all()
+        df_read.insert(0, 'Year', df_read.index.year)
+        df_read.insert(1, 'Month', df_read.index.month)
+        df_read.insert(2, 'Day', df_read.index.day)
+        dly_files.append(tmp_path / f'station_{file_format}.dly')
+        convert2dly(df_read, str(dly_files[-1]))
+    assert dly_files[0].read_bytes() == dly_files[1].read_bytes()
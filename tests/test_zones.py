@@ -0,0 +1,30 @@
+"""
+The zone label grid cached next to the zone file must follow edits of the polygons, see get_zone_index
+"""
+import geopandas as gpd
+import shapely
+from test_fingerprint import write_prism_grid
+from Utility import get_zone_index
+from Utility import read_bil_file
+
+# Pixel centers of the 3 x 4 test grid start at -125 (ULXMAP) and are 1 / 24 degree apart
+COLUMN = 1 / 24
+
+
+def make_zones(first_column):
+    west = -125 + (first_column - 0.5) * COLUMN
+    boxes = [shapely.box(west + k * COLUMN, 49.8, west + (k + 1) * COLUMN, 49.95) for k in range(2)]
+    return gpd.GeoDataFrame({'Name': ['a', 'b']}, geometry=boxes, crs='EPSG:4269')
+
+
+def test_edited_zones_are_indexed_again(tmp_path):
+    write_prism_grid(str(tmp_path))
+    raster = read_bil_file(str(tmp_path), 'ppt', '2020', '20200101', 'daily')
+    zone_file_path = str(tmp_path / 'zones.shp')
+    zone_index = get_zone_index(zone_file_path, make_zones(0), raster)
+    assert sorted(set(zone_index['pixels'] % 4)) == [0, 1]
+    # same ids and count, polygons moved one column east
+    for cached in [zone_index, None]:
+        moved = get_zone_index(zone_file_path, make_zones(1), raster, cached)
+        assert sorted(set(moved['pixels'] % 4)) == [1, 2]
+    raster.close()